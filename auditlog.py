@@ -0,0 +1,287 @@
+import Queue
+import calendar
+import errno
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+
+class JsonLogger(object):
+    """Audit log of auth events, one JSON object per line.
+
+    write() only queues the record, so a slow disk never holds up packet
+    handling. A writer thread appends whatever has queued up in one go and
+    flushes and fsyncs it, waiting at most sync_interval seconds between
+    commits. The file name comes from template via strftime on the time of
+    each record. When the name changes the finished file is gzipped in the
+    background to <name>.gz; when it grows past max_size bytes it is
+    renamed to <name>.<n>, gzipped to <name>.<n>.gz, and a new <name> is
+    started. Files left uncompressed by an earlier run are compressed by
+    start().
+    """
+
+    def __init__(self, template="%Y-%m-%d.log", localtime=False, sync_interval=1.0,
+                 max_size=0, compress=True, max_queue=100000):
+        self.template = template
+        if localtime:
+            self.timefunction = time.localtime
+        else:
+            self.timefunction = time.gmtime
+        self.sync_interval = sync_interval
+        self.max_size = max_size
+        self.compress = compress
+        self.queue = Queue.Queue(max_queue)
+        self.filename = None
+        self.fh = None
+        self.dropped = 0
+        self.compressor = Queue.Queue()
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.compress:
+            # closed daily and size-rotated files an earlier run left behind
+            closed = re.compile(re.sub(r"\\%.", ".+", re.escape(self.template)) + r"(\.\d+)?$")
+            current = time.strftime(self.template, self.timefunction(time.time()))
+            for filename in log_files(self.template):
+                if closed.match(filename) and filename != current:
+                    self.compressor.put(filename)
+        for target in [self._write_loop, self._compress_loop]:
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+
+    def write(self, data):
+        now = time.time()
+        if not data.has_key("timestamp"):
+            data["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now))
+        try:
+            self.queue.put_nowait((now, data))
+        except Queue.Full:
+            self.dropped += 1
+            logging.error("AuthLogger queue full, dropped record %r" % (data))
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def _write_loop(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time()+self.sync_interval
+            while True:
+                try:
+                    batch.append(self.queue.get(True, max(0, deadline-time.time())))
+                except Queue.Empty:
+                    break
+            try:
+                self._commit(batch)
+            except Exception:
+                logging.exception("AuthLogger exception")
+
+    def _commit(self, batch):
+        lines = []
+        for timestamp, data in batch:
+            filename = time.strftime(self.template, self.timefunction(timestamp))
+            if filename != self.filename:
+                self._write_lines(lines)
+                lines = []
+                self._open(filename)
+            lines.append(json.dumps(data)+"\r\n")
+        self._write_lines(lines)
+
+    def _write_lines(self, lines):
+        if not lines:
+            return
+        self.fh.write("".join(lines))
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        if self.max_size and self.fh.tell() >= self.max_size:
+            self._rotate()
+            self._open(self.filename)
+
+    def _open(self, filename):
+        if self.fh is not None:
+            self._close()
+        with self.lock:
+            self.fh = open(filename, "a")
+            self.fh.seek(0, os.SEEK_END)
+            self.filename = filename
+
+    def _close(self):
+        """Close the current file and hand it over for compression."""
+        self.fh.close()
+        self.fh = None
+        if self.compress:
+            self.compressor.put(self.filename)
+
+    def _rotate(self):
+        """Close the current file and move it aside as <name>.<n>."""
+        self.fh.close()
+        self.fh = None
+        n = 1
+        while os.path.exists("%s.%d" % (self.filename, n)) or os.path.exists("%s.%d.gz" % (self.filename, n)):
+            n += 1
+        rotated = "%s.%d" % (self.filename, n)
+        try:
+            os.rename(self.filename, rotated)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        if self.compress:
+            self.compressor.put(rotated)
+
+    def _compress_loop(self):
+        while True:
+            filename = self.compressor.get()
+            try:
+                self._compress(filename)
+            except Exception:
+                logging.exception("AuthLogger unable to compress %s" % (filename))
+
+    def _compress(self, filename):
+        target = filename+".gz"
+        tmp = target+".tmp"
+        if os.path.exists(target):
+            # reopened after it was compressed, e.g. for a late record;
+            # gzip readers see the two members as one stream
+            shutil.copyfile(target, tmp)
+            dst = gzip.open(tmp, "ab")
+        else:
+            dst = gzip.open(tmp, "wb")
+        src = open(filename, "rb")
+        shutil.copyfileobj(src, dst)
+        src.close()
+        dst.close()
+        with self.lock:
+            if filename == self.filename and self.fh is not None:
+                # reopened while being compressed; it is queued again
+                # when next closed
+                os.unlink(tmp)
+                return
+            os.rename(tmp, target)
+            os.unlink(filename)
+
+def log_files(template):
+    """All files written for a JsonLogger template, including rotated ones."""
+    pattern = re.sub(r"%.", "*", template) + "*"
+    return sorted([f for f in glob.glob(pattern) if not f.endswith(".tmp")])
+
+def open_log(filename):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rb")
+    return open(filename, "rb")
+
+def parse_timestamp(timestamp):
+    return calendar.timegm(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ"))
+
+class AuditIndex(object):
+    """sqlite index over the audit log files, for searching by uid, name,
+    door and time without reading every file.
+
+    Each record is stored with its original JSON line so results can be
+    streamed straight from the index. A file is only read again when it
+    has changed, and then reading resumes at the last indexed offset.
+    Rotation renames and compresses files, so a record is identified by
+    its file's content (the hash of the first line) and its offset in the
+    uncompressed data rather than by file name; re-reading a rotated file
+    then adds nothing twice.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime REAL, offset INTEGER);
+            CREATE TABLE IF NOT EXISTS records (
+                id TEXT PRIMARY KEY, time INTEGER, uid TEXT, name TEXT COLLATE NOCASE,
+                door TEXT COLLATE NOCASE, authorized INTEGER, line TEXT);
+            CREATE INDEX IF NOT EXISTS records_time ON records (time);
+            CREATE INDEX IF NOT EXISTS records_uid ON records (uid, time);
+            CREATE INDEX IF NOT EXISTS records_name ON records (name, time);
+            CREATE INDEX IF NOT EXISTS records_door ON records (door, time);
+            """)
+
+    def update(self, filenames):
+        """Index whatever is new in filenames; returns the number of records added."""
+        added = 0
+        for filename in filenames:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            row = self.db.execute("SELECT inode, size, mtime, offset FROM files WHERE path = ?", (filename,)).fetchone()
+            if row and row[0] == st.st_ino and row[1] == st.st_size and row[2] == st.st_mtime:
+                continue
+            offset = 0
+            if row and row[0] == st.st_ino and not filename.endswith(".gz") and row[3] <= st.st_size:
+                offset = row[3]
+            added += self._index_file(filename, st, offset)
+        self.db.commit()
+        return added
+
+    def _index_file(self, filename, st, offset):
+        fh = open_log(filename)
+        added = 0
+        end = 0
+        try:
+            line = fh.readline()
+            if line.endswith("\n"):
+                chunk = hashlib.sha1(line).hexdigest()[:16]
+                if offset:
+                    fh.seek(offset)
+                    end = offset
+                    line = fh.readline()
+                while line.endswith("\n"):
+                    added += self._add(line, "%s:%d" % (chunk, end))
+                    end += len(line)
+                    line = fh.readline()
+                # anything left is a record still being written
+        finally:
+            fh.close()
+        self.db.execute("INSERT OR REPLACE INTO files (path, inode, size, mtime, offset) VALUES (?, ?, ?, ?, ?)",
+                        (filename, st.st_ino, st.st_size, st.st_mtime, end))
+        return added
+
+    def _add(self, line, record_id):
+        try:
+            data = json.loads(line)
+            t = parse_timestamp(data["timestamp"])
+        except (ValueError, KeyError):
+            logging.warning("skipping unparseable audit record %r" % (line))
+            return 0
+        authorized = data.get("authorized")
+        if authorized is not None:
+            authorized = int(bool(authorized))
+        cursor = self.db.execute("INSERT OR IGNORE INTO records (id, time, uid, name, door, authorized, line) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 (record_id, t, data.get("uid"), data.get("name"), data.get("door"), authorized, line.rstrip("\r\n")))
+        return cursor.rowcount
+
+    def query(self, uid=None, name=None, door=None, authorized=None, since=None, until=None, limit=None):
+        """Matching JSON lines in time order, as a generator."""
+        where = []
+        args = []
+        for column, value in [("uid", uid), ("name", name), ("door", door), ("authorized", authorized)]:
+            if value is not None:
+                where.append("%s = ?" % (column))
+                args.append(value)
+        if since is not None:
+            where.append("time >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("time < ?")
+            args.append(until)
+        sql = "SELECT line FROM records"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY time, rowid"
+        if limit:
+            sql += " LIMIT %d" % (limit)
+        for row in self.db.execute(sql, args):
+            yield row[0]
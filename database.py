@@ -1,7 +1,11 @@
-import json
+import collections
+import hashlib
 import logging
+import marshal
 import os
+import sqlite3
 import string
+import sys
 import ConfigParser
 
 class ReaderNotFound(Exception):
@@ -9,12 +13,25 @@ class ReaderNotFound(Exception):
 	
 class CardDatabase(object):
 
-    def __init__(self, cards_filename, readers_filename):
+    # recent auth() results, keyed by (reader, uid, generation)
+    auth_cache_size = 4096
+    snapshot_version = 1
+
+    def __init__(self, cards_filename, readers_filename, snapshot_filename=None):
         self.cards_filename = cards_filename
         self.readers_filename = readers_filename
+        self.snapshot_filename = snapshot_filename
         self.cards_filetime = None
         self.readers_filetime = None
         self.data = None
+        self.uid_index = {}
+        self.reader_groups = {}
+        self.reader_cards = {}
+        self.generation = 0
+        self.reader_generations = {}
+        self.auth_cache = collections.OrderedDict()
+        self.auth_cache_hits = 0
+        self.auth_cache_misses = 0
         self.reload()
 
     def _load_cards(self):
@@ -51,15 +68,138 @@ class CardDatabase(object):
                     data[readerid]["settings"][option] = c.get(readerid, option)
         return data
 
+    def _build_indexes(self, data):
+        # uid -> tuple of (person, token_name, private, groups) entries; a uid
+        # is normally held by one person but duplicates are kept so that auth()
+        # behaves as the old linear scan did
+        uid_index = {}
+        group_uids = {}
+        for person, p in data["people"].items():
+            groups = tuple(p["groups"])
+            for uid, token_name in p["cards"].items():
+                entry = (person, token_name, p["private"], groups)
+                uid_index[uid] = uid_index.get(uid, ()) + (entry,)
+            for group in groups:
+                group_uids.setdefault(group, set()).update(p["cards"].keys())
+        reader_groups = {}
+        reader_cards = {}
+        for readerid, r in data["readers"].items():
+            allowed = frozenset(r["groups"])
+            uids = set()
+            for group in allowed:
+                uids.update(group_uids.get(group, ()))
+            reader_groups[readerid] = allowed
+            reader_cards[readerid] = tuple(sorted(uids))
+        return uid_index, reader_groups, reader_cards
+
+    def _diff_readers(self, old_readers, old_cards, new_readers, new_cards):
+        changes = {}
+        for readerid in new_readers.keys():
+            if readerid not in old_readers:
+                changes[readerid] = {"added": list(new_cards[readerid]), "removed": [], "settings": sorted(new_readers[readerid]["settings"].keys())}
+                continue
+            old = set(old_cards[readerid])
+            new = set(new_cards[readerid])
+            old_settings = old_readers[readerid]["settings"]
+            new_settings = new_readers[readerid]["settings"]
+            settings = [k for k in set(old_settings.keys()) | set(new_settings.keys()) if old_settings.get(k) != new_settings.get(k)]
+            if old != new or settings:
+                changes[readerid] = {"added": sorted(new - old), "removed": sorted(old - new), "settings": sorted(settings)}
+        return changes
+
+    def _stat_sources(self):
+        return [(os.path.getmtime(f), os.path.getsize(f)) for f in [self.cards_filename, self.readers_filename]]
+
+    def _hash_sources(self):
+        return [hashlib.sha1(open(f, "rb").read()).hexdigest() for f in [self.cards_filename, self.readers_filename]]
+
+    def _load_snapshot(self, stats):
+        """Return (data, indexes) from the snapshot if it matches the sources.
+
+        The snapshot is marshalled, whose format depends on the Python
+        version, so one written by another version is ignored and rebuilt.
+        marshal needs the whole file as a string, so it is simply read.
+        """
+        try:
+            fh = open(self.snapshot_filename, "rb")
+        except IOError:
+            return None
+        try:
+            snapshot = marshal.load(fh)
+        except (ValueError, EOFError, TypeError):
+            logging.warning("ignoring unreadable database snapshot %s" % (self.snapshot_filename))
+            return None
+        finally:
+            fh.close()
+        if type(snapshot) is not dict or snapshot.get("version") != self.snapshot_version \
+                or snapshot.get("python") != tuple(sys.version_info[:2]):
+            return None
+        if snapshot["stats"] != stats:
+            # touched but perhaps not changed
+            if snapshot["hashes"] != self._hash_sources():
+                return None
+            logging.debug("database sources touched but unchanged")
+            self._save_snapshot(stats, snapshot["hashes"], snapshot["data"], snapshot["indexes"])
+        return snapshot["data"], snapshot["indexes"]
+
+    def _save_snapshot(self, stats, hashes, data, indexes):
+        tmp = "%s.%d.tmp" % (self.snapshot_filename, os.getpid())
+        try:
+            directory = os.path.dirname(self.snapshot_filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            fh = open(tmp, "wb")
+            marshal.dump({"version": self.snapshot_version, "python": tuple(sys.version_info[:2]), "stats": stats, "hashes": hashes,
+                          "data": data, "indexes": indexes}, fh)
+            fh.close()
+            os.rename(tmp, self.snapshot_filename)
+        except (IOError, OSError):
+            logging.exception("unable to write database snapshot %s" % (self.snapshot_filename))
+
+    def _load(self):
+        """Parse the sources, or take them ready-made from the snapshot."""
+        stats = self._stat_sources()
+        if self.snapshot_filename:
+            snapshot = self._load_snapshot(stats)
+            if snapshot is not None:
+                logging.debug("database loaded from snapshot %s" % (self.snapshot_filename))
+                return stats, snapshot[0], snapshot[1]
+            hashes = self._hash_sources()
+        data = {"people": self._load_cards(), "readers": self._load_readers()}
+        indexes = self._build_indexes(data)
+        if self.snapshot_filename:
+            self._save_snapshot(stats, hashes, data, indexes)
+        return stats, data, indexes
+
     def reload(self):
-        new_cards_filetime = os.path.getmtime(self.cards_filename)
-        new_readers_filetime = os.path.getmtime(self.readers_filename)
-        new_data = {"people": self._load_cards(), "readers": self._load_readers()}
+        stats, new_data, indexes = self._load()
+        new_cards_filetime = stats[0][0]
+        new_readers_filetime = stats[1][0]
+        uid_index, reader_groups, reader_cards = indexes
+        if self.data is None:
+            changes = {}
+        else:
+            changes = self._diff_readers(self.data["readers"], self.reader_cards, new_data["readers"], reader_cards)
+        self.generation += 1
+        self._record_changes(new_data["readers"], changes)
         self.data = new_data
+        self.uid_index = uid_index
+        self.reader_groups = reader_groups
+        self.reader_cards = reader_cards
         self.cards_filetime = new_cards_filetime
         self.readers_filetime = new_readers_filetime
-        logging.debug("database reloaded")
-        logging.debug(json.dumps(self.data, indent=2))
+        logging.debug("database reloaded: %d people, %d cards, %d readers" % (len(self.data["people"]), len(self.uid_index), len(self.data["readers"])))
+
+    def _record_changes(self, readers, changes):
+        """Note the current generation against readers whose cards changed."""
+        for readerid in readers.keys():
+            if readerid not in self.reader_generations:
+                self.reader_generations[readerid] = self.generation
+        for readerid, change in changes.items():
+            if change["added"] or change["removed"]:
+                self.reader_generations[readerid] = self.generation
+            logging.info("database change for reader %s: %d added, %d removed, settings changed %r" % (readerid, len(change["added"]), len(change["removed"]), change["settings"]))
+        self.auth_cache.clear()
 
     def autoreload(self):
         if self.cards_filetime is None or self.readers_filetime is None:
@@ -75,34 +215,44 @@ class CardDatabase(object):
     def timestamp(self):
         return max(self.cards_filetime, self.readers_filetime)
 
+    def reader_generation(self, reader):
+        # generation of the last reload that changed this reader's card list
+        return self.reader_generations.get(reader, self.generation)
+
     def auth(self, reader, uid):
         uid = uid.upper()
+        key = (reader, uid, self.generation)
+        result = self.auth_cache.pop(key, None)
+        if result is not None:
+            self.auth_cache_hits += 1
+            self.auth_cache[key] = result
+            logging.debug("uid %s on reader %s: cached result %r" % (uid, reader, result[0]))
+            return result
+        self.auth_cache_misses += 1
+        result = self._auth(reader, uid)
+        self.auth_cache[key] = result
+        if len(self.auth_cache) > self.auth_cache_size:
+            self.auth_cache.popitem(last=False)
+        return result
+
+    def _auth(self, reader, uid):
         logging.debug("attempting to authorize %s on reader %s" % (uid, reader))
-        allowed_groups = self.data["readers"][reader]["groups"]
-        logging.debug("allowed groups for reader %s are %r" % (reader, allowed_groups))
-        for person in self.data["people"].keys():
-            for card in self.data["people"][person]["cards"].keys():
-                token_name = self.data["people"][person]["cards"][card]
-                if uid == card:
-                    logging.debug("uid %s belongs to %s (%s)" % (uid, person, token_name))
-                    for group in self.data["people"][person]["groups"]:
-                        if group in allowed_groups:
-                            logging.info("uid %s (%s) is authorized to use reader %s via group %s" % (uid, person, reader, group))
-                            private = self.data["people"][person]["private"]
-                            return True, person, token_name, private
+        allowed_groups = self.reader_groups[reader]
+        logging.debug("allowed groups for reader %s are %r" % (reader, sorted(allowed_groups)))
+        for person, token_name, private, groups in self._uid_entries(uid):
+            logging.debug("uid %s belongs to %s (%s)" % (uid, person, token_name))
+            for group in groups:
+                if group in allowed_groups:
+                    logging.info("uid %s (%s) is authorized to use reader %s via group %s" % (uid, person, reader, group))
+                    return True, person, token_name, private
         logging.info("uid %s is not authorized to use reader %s" % (uid, reader))
         return False, None, None, None
 
+    def _uid_entries(self, uid):
+        return self.uid_index.get(uid, ())
+
     def cards_for_reader(self, reader):
-        uids = {}
-        groups = self.data["readers"][reader]["groups"]
-        for person in self.data["people"].keys():
-            for group in self.data["people"][person]["groups"]:
-                if group in groups:
-                    #logging.debug("adding %s to reader %s (group %s)" % (person, reader, group))
-                    for uid in self.data["people"][person]["cards"].keys():
-                        uids[uid] = True
-        return sorted(uids.keys())
+        return list(self.reader_cards[reader])
 
     def reader_name(self, reader):
         try:
@@ -115,3 +265,255 @@ class CardDatabase(object):
 
     def reader_settings(self, reader):
         return self.data["readers"][reader]["settings"]
+
+class SqliteCardDatabase(CardDatabase):
+    """CardDatabase kept in an SQLite file instead of the two .conf files.
+
+    Triggers append every edit to the changes table, whose sequence number
+    is the database generation. autoreload() reads only the rows after the
+    last one applied and recomputes just the readers they affect, so a
+    single membership edit costs a few indexed queries rather than a full
+    reload. Everything auth() needs is kept in memory as in CardDatabase,
+    and each poll reads inside one transaction, so an answer always comes
+    from a single generation of the database.
+
+    Rows older than full_reload_threshold changes are pruned from the feed
+    as it is applied.
+    """
+
+    # more changes than this at once (e.g. a bulk import) are applied by
+    # reloading everything
+    full_reload_threshold = 1000
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS people (name TEXT PRIMARY KEY, private INTEGER NOT NULL DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS person_groups (person TEXT NOT NULL, grp TEXT NOT NULL, PRIMARY KEY (person, grp));
+        CREATE INDEX IF NOT EXISTS person_groups_grp ON person_groups (grp, person);
+        CREATE TABLE IF NOT EXISTS cards (uid TEXT NOT NULL, person TEXT NOT NULL, token_name TEXT, PRIMARY KEY (uid, person));
+        CREATE INDEX IF NOT EXISTS cards_person ON cards (person);
+        CREATE TABLE IF NOT EXISTS readers (id TEXT PRIMARY KEY, name TEXT, mqtt_id TEXT);
+        CREATE TABLE IF NOT EXISTS reader_groups (reader TEXT NOT NULL, grp TEXT NOT NULL, PRIMARY KEY (reader, grp));
+        CREATE INDEX IF NOT EXISTS reader_groups_grp ON reader_groups (grp);
+        CREATE TABLE IF NOT EXISTS reader_settings (reader TEXT NOT NULL, key TEXT NOT NULL, value TEXT, PRIMARY KEY (reader, key));
+        CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, tbl TEXT NOT NULL, key TEXT NOT NULL);
+        """
+
+    # table -> column naming the person or reader an edit affects
+    feed_keys = [("people", "name"), ("person_groups", "person"), ("cards", "person"),
+                 ("readers", "id"), ("reader_groups", "reader"), ("reader_settings", "reader")]
+    person_tables = ["people", "person_groups", "cards"]
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = None
+        self.conn_pid = None
+        self.data = None
+        self.people = {}
+        self.uid_index = {}
+        self.reader_groups = {}
+        self.reader_cards = {}
+        self.generation = 0
+        self.reader_generations = {}
+        self.auth_cache = collections.OrderedDict()
+        self.auth_cache_hits = 0
+        self.auth_cache_misses = 0
+        self.create(self._db())
+        self.reload()
+
+    @classmethod
+    def create(cls, conn):
+        conn.executescript(cls.schema)
+        for table, column in cls.feed_keys:
+            conn.executescript("""
+                CREATE TRIGGER IF NOT EXISTS %(t)s_insert AFTER INSERT ON %(t)s BEGIN
+                    INSERT INTO changes (tbl, key) VALUES ('%(t)s', NEW.%(c)s); END;
+                CREATE TRIGGER IF NOT EXISTS %(t)s_update AFTER UPDATE ON %(t)s BEGIN
+                    INSERT INTO changes (tbl, key) VALUES ('%(t)s', OLD.%(c)s);
+                    INSERT INTO changes (tbl, key) SELECT '%(t)s', NEW.%(c)s WHERE NEW.%(c)s != OLD.%(c)s; END;
+                CREATE TRIGGER IF NOT EXISTS %(t)s_delete AFTER DELETE ON %(t)s BEGIN
+                    INSERT INTO changes (tbl, key) VALUES ('%(t)s', OLD.%(c)s); END;
+                """ % {"t": table, "c": column})
+        conn.commit()
+
+    def _db(self):
+        # a connection must not be shared with a forked shard worker
+        if self.conn_pid != os.getpid():
+            # transactions are begun explicitly, see _read()
+            self.conn = sqlite3.connect(self.filename, check_same_thread=False, isolation_level=None)
+            self.conn.text_factory = str
+            self.conn_pid = os.getpid()
+        return self.conn
+
+    def _feed_position(self):
+        return self._db().execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+    def _load_reader(self, readerid):
+        db = self._db()
+        row = db.execute("SELECT name, mqtt_id FROM readers WHERE id = ?", (readerid,)).fetchone()
+        if row is None:
+            return None
+        groups = [grp for (grp,) in db.execute("SELECT grp FROM reader_groups WHERE reader = ? ORDER BY grp", (readerid,))]
+        settings = dict(db.execute("SELECT key, value FROM reader_settings WHERE reader = ?", (readerid,)))
+        return {"name": row[0] or readerid, "id": row[1] or readerid, "groups": groups, "settings": settings}
+
+    def _load_reader_cards(self, readerid):
+        return tuple([uid for (uid,) in self._db().execute("""
+            SELECT DISTINCT c.uid FROM reader_groups rg
+            JOIN person_groups g ON g.grp = rg.grp
+            JOIN cards c ON c.person = g.person
+            WHERE rg.reader = ? ORDER BY c.uid""", (readerid,))])
+
+    def _load_people(self):
+        # person -> (private, groups, {uid: token_name}), covering anyone
+        # named in any of the person tables
+        db = self._db()
+        people = {}
+        for name, private in db.execute("SELECT name, private FROM people"):
+            people[name] = (bool(private), (), {})
+        for person, grp in db.execute("SELECT person, grp FROM person_groups ORDER BY person, grp"):
+            private, groups, cards = people.get(person, (False, (), {}))
+            people[person] = (private, groups + (grp,), cards)
+        for uid, person, token_name in db.execute("SELECT uid, person, token_name FROM cards"):
+            people.setdefault(person, (False, (), {}))[2][uid] = token_name
+        return people
+
+    def _load_person(self, person):
+        db = self._db()
+        row = db.execute("SELECT private FROM people WHERE name = ?", (person,)).fetchone()
+        groups = tuple([grp for (grp,) in db.execute("SELECT grp FROM person_groups WHERE person = ? ORDER BY grp", (person,))])
+        cards = dict(db.execute("SELECT uid, token_name FROM cards WHERE person = ?", (person,)))
+        if row is None and not groups and not cards:
+            return None
+        return (bool(row and row[0]), groups, cards)
+
+    def _read(self, function, *args):
+        """Run function inside one read transaction, so it sees one version."""
+        db = self._db()
+        db.execute("BEGIN")
+        try:
+            return function(*args)
+        finally:
+            db.execute("COMMIT")
+
+    def reload(self):
+        self._read(self._reload)
+        self._prune()
+
+    def _reload(self):
+        db = self._db()
+        generation = self._feed_position()
+        readers = {}
+        for (readerid,) in db.execute("SELECT id FROM readers").fetchall():
+            readers[readerid] = self._load_reader(readerid)
+        people = self._load_people()
+        uid_index = {}
+        for person, (private, groups, cards) in people.items():
+            for uid, token_name in cards.items():
+                uid_index[uid] = uid_index.get(uid, ()) + ((person, token_name, private, groups),)
+        reader_cards = {}
+        for readerid in readers.keys():
+            reader_cards[readerid] = self._load_reader_cards(readerid)
+        if self.data is None:
+            changes = {}
+        else:
+            changes = self._diff_readers(self.data["readers"], self.reader_cards, readers, reader_cards)
+        self.generation = generation
+        self._record_changes(readers, changes)
+        self.data = {"readers": readers}
+        self.people = people
+        self.uid_index = uid_index
+        self.reader_groups = dict([(r, frozenset(info["groups"])) for r, info in readers.items()])
+        self.reader_cards = reader_cards
+        logging.debug("database reloaded from %s at generation %d: %d people, %d cards, %d readers" % (self.filename, generation, len(people), len(uid_index), len(readers)))
+
+    def autoreload(self):
+        if self._read(self._poll):
+            self._prune()
+
+    def _poll(self):
+        """Apply new changes from the feed; True if there were any."""
+        db = self._db()
+        first, last, count = db.execute("SELECT MIN(seq), MAX(seq), COUNT(*) FROM changes WHERE seq > ?", (self.generation,)).fetchone()
+        if count == 0:
+            return False
+        oldest = db.execute("SELECT MIN(seq) FROM changes").fetchone()[0]
+        if count > self.full_reload_threshold or (self.generation and oldest > self.generation+1):
+            logging.debug("%d database changes, reloading" % (count))
+            self._reload()
+            return True
+        people = set()
+        readerids = set()
+        for tbl, key in db.execute("SELECT tbl, key FROM changes WHERE seq > ? AND seq <= ?", (self.generation, last)):
+            if tbl in self.person_tables:
+                people.add(key)
+            else:
+                readerids.add(key)
+        logging.debug("applying database changes %d-%d: %d people, %d readers" % (first, last, len(people), len(readerids)))
+        self._apply(last, people, readerids)
+        return True
+
+    def _prune(self):
+        """Drop feed rows no process could still apply incrementally.
+
+        Each controller process (and each shard worker) follows the feed
+        on its own, so rows are kept for full_reload_threshold changes
+        behind the newest; anyone further behind reloads everything anyway.
+        """
+        try:
+            self._db().execute("DELETE FROM changes WHERE seq <= ?", (self.generation-self.full_reload_threshold,))
+        except sqlite3.OperationalError, e:
+            # e.g. locked by an import in progress; try again next time
+            logging.debug("unable to prune database changes: %s" % (e))
+
+    def _apply(self, generation, changed_people, readerids):
+        readers = dict(self.data["readers"])
+        for readerid in readerids:
+            info = self._load_reader(readerid)
+            if info is None:
+                readers.pop(readerid, None)
+            else:
+                readers[readerid] = info
+        groups = set()
+        people = dict(self.people)
+        uid_index = dict(self.uid_index)
+        for person in changed_people:
+            old = people.pop(person, None)
+            if old is not None:
+                groups.update(old[1])
+                for uid in old[2].keys():
+                    entries = tuple([e for e in uid_index.get(uid, ()) if e[0] != person])
+                    if entries:
+                        uid_index[uid] = entries
+                    else:
+                        del uid_index[uid]
+            new = self._load_person(person)
+            if new is None:
+                continue
+            people[person] = new
+            private, person_groups, cards = new
+            groups.update(person_groups)
+            for uid, token_name in cards.items():
+                uid_index[uid] = uid_index.get(uid, ()) + ((person, token_name, private, person_groups),)
+        affected = set([r for r in readerids if readers.has_key(r)])
+        for readerid, info in readers.items():
+            if groups.intersection(info["groups"]):
+                affected.add(readerid)
+        reader_cards = dict([(r, c) for r, c in self.reader_cards.items() if readers.has_key(r)])
+        old_readers = {}
+        new_readers = {}
+        for readerid in affected:
+            reader_cards[readerid] = self._load_reader_cards(readerid)
+            new_readers[readerid] = readers[readerid]
+            if self.data["readers"].has_key(readerid):
+                old_readers[readerid] = self.data["readers"][readerid]
+        changes = self._diff_readers(old_readers, self.reader_cards, new_readers, reader_cards)
+        self.generation = generation
+        self._record_changes(readers, changes)
+        self.data = {"readers": readers}
+        self.people = people
+        self.uid_index = uid_index
+        self.reader_groups = dict([(r, frozenset(info["groups"])) for r, info in readers.items()])
+        self.reader_cards = reader_cards
+
+    def timestamp(self):
+        return self.generation
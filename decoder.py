@@ -1,3 +1,4 @@
+import binascii
 import struct
 import logging
 import pprint
@@ -84,27 +85,47 @@ def reverse_data_variables(fwd):
 rev_data_variables = reverse_data_variables(data_variables)
 #pprint.pprint(rev_data_variables)
 
-def decode_var(data):
-    var_type = ord(data[0])
-    name, fmt, process = data_variables[var_type]
-    required_length = struct.calcsize(fmt)
-    unpacked = struct.unpack(fmt, data[1:required_length+1])
-    remaining = data[required_length+1:]
-    if process is None:
-        # treat as number
-        return (name, unpacked[0], remaining)
-    elif type(process) in [int, float]:
-        # treat as a divider
-        return (name, unpacked[0]/process, remaining)
-    elif type(process) in [str, unicode]:
-        # treat as a format string
-        return (name, process % unpacked, remaining)
-    elif type(process) is dict:
-        # treat as lookup table
-        return (name, process[unpacked[0]], remaining)
+VAR_NUMBER, VAR_DIVIDER, VAR_FORMAT, VAR_LOOKUP, VAR_FUNCTION = range(5)
+
+def build_var_decoders(fwd):
+    """Precompile data_variables into {code byte: (name, Struct, kind, process)}."""
+    decoders = {}
+    for i in fwd.keys():
+        name, fmt, process = fwd[i]
+        if process is None:
+            kind = VAR_NUMBER
+        elif type(process) in [int, float]:
+            kind = VAR_DIVIDER
+        elif type(process) in [str, unicode]:
+            kind = VAR_FORMAT
+        elif type(process) is dict:
+            kind = VAR_LOOKUP
+        else:
+            kind = VAR_FUNCTION
+        decoders[chr(i)] = (name, struct.Struct(fmt), kind, process)
+    return decoders
+
+var_decoders = build_var_decoders(data_variables)
+
+def decode_var_at(data, offset):
+    """Decode the variable starting at data[offset], returning (name, value, next_offset)."""
+    name, s, kind, process = var_decoders[data[offset]]
+    unpacked = s.unpack_from(data, offset+1)
+    if kind == VAR_NUMBER:
+        value = unpacked[0]
+    elif kind == VAR_LOOKUP:
+        value = process[unpacked[0]]
+    elif kind == VAR_DIVIDER:
+        value = unpacked[0]/process
+    elif kind == VAR_FORMAT:
+        value = process % unpacked
     else:
-        # treat as function
-        return (name, process(*unpacked), remaining)
+        value = process(*unpacked)
+    return (name, value, offset+1+s.size)
+
+def decode_var(data):
+    name, value, offset = decode_var_at(data, 0)
+    return (name, value, data[offset:])
 
 def encode_var(name, value):
     if value.lower() == 'true':
@@ -124,7 +145,70 @@ def encode_var(name, value):
         # treat as lookup table
         return struct.pack("B", var_code) + struct.pack(fmt, process[value])
 
+# largest datagram encode_packets() will produce. Each datagram has to fit
+# the path MTU to the reader, since a fragmented one is lost whenever any
+# of its fragments is; 1280 (the IPv6 minimum link MTU) leaves room for
+# the IP and UDP headers within a 1500 byte Ethernet MTU
+DEFAULT_MAX_PAYLOAD = 1280
+
+slot_header_struct = struct.Struct(">HB")
+
+def encode_databaseset(slots, max_payload=None):
+    """Encode a databaseset as datagrams of at most max_payload bytes."""
+    entries = [(int(slot), dehexify(uid)) for slot, uid in slots.items()]
+    entries.sort()
+    if max_payload is None:
+        max_payload = 1 + sum([3+len(uid) for slot, uid in entries])
+    pack_into = slot_header_struct.pack_into
+    buf = bytearray(max_payload)
+    buf[0] = 0x93
+    offset = 1
+    packets = []
+    for slot, uid in entries:
+        end = offset+3+len(uid)
+        if end > max_payload and offset > 1:
+            packets.append(str(buf[:offset]))
+            offset = 1
+            end = offset+3+len(uid)
+        pack_into(buf, offset, slot, len(uid))
+        buf[offset+3:end] = uid
+        offset = end
+    if offset > 1 or not packets:
+        packets.append(str(buf[:offset]))
+    return packets
+
+def encode_variableset(data, max_payload=None):
+    chunks = []
+    for k, v in data.iteritems():
+        if k != "type":
+            chunk = encode_var(k, v)
+            if chunk:
+                chunks.append(chr(0x97) + chunk)
+    if max_payload is None:
+        return ["".join(chunks)]
+    packets = []
+    current = []
+    size = 0
+    for chunk in chunks:
+        if size+len(chunk) > max_payload and current:
+            packets.append("".join(current))
+            current = []
+            size = 0
+        current.append(chunk)
+        size += len(chunk)
+    if current:
+        packets.append("".join(current))
+    return packets
+
+def _whole(packets, kind):
+    # without a max_payload the encoders return the message as one
+    # datagram; never hand back part of it
+    if len(packets) != 1:
+        raise ValueError("%s split into %d datagrams, use encode_packets()" % (kind, len(packets)))
+    return packets[0]
+
 def encode_packet(data):
+    """Encode a message as one datagram, however large; see encode_packets()."""
     if data["type"] == "helloreply":
         return chr(0x80)
     if data["type"] == "authresponse":
@@ -138,117 +222,132 @@ def encode_packet(data):
         output = chr(0x95) + struct.pack(">HH", data["start"], data["end"])
         return output
     if data["type"] == "databaseset":
-        output = chr(0x93)
-        for slot in data["slots"].keys():
-            output = output + struct.pack(">H", int(slot)) + chr(len(data["slots"][slot])/2) + dehexify(data["slots"][slot])
-        return output
+        return _whole(encode_databaseset(data["slots"]), "databaseset")
     if data["type"] == "commiteeprom":
         output = chr(0x94)
         return output
     if data["type"] == "variableset":
-        output = ""
-        for k, v in data.iteritems():
-            if k != "type":
-                chunk = encode_var(k, v)
-                if chunk:
-                    output = output + chr(0x97) + chunk
-        return output
+        return _whole(encode_variableset(data), "variableset")
+
+def encode_packets(data, max_payload=DEFAULT_MAX_PAYLOAD):
+    """Encode a message as a list of ready to send datagrams.
+
+    databaseset and variableset messages are split so that each datagram
+    carries as many entries as fit in max_payload bytes.
+    """
+    if data["type"] == "databaseset":
+        return encode_databaseset(data["slots"], max_payload)
+    if data["type"] == "variableset":
+        return encode_variableset(data, max_payload)
+    encoded = encode_packet(data)
+    if encoded is None:
+        return []
+    return [encoded]
+
+systeminfo_struct = struct.Struct(">BBBBIIIIIHHI")
+status_struct = struct.Struct(">BBBBHB")
+databasedump_struct = struct.Struct(">HB7s")
+
+def decode_hello(data):
+    return {"type": "hello", "clientid": data[1:].rstrip(chr(0))}
+
+def decode_systeminfo(data):
+    cmd, padding1, padding2, padding3, chipId, flashChipId, flashChipSize, flashChipSpeed, freeHeap, cardDatabaseSize, padding4, millis = systeminfo_struct.unpack_from(data)
+    output = {
+        "type": "systeminfo",
+        "chipId": "%08X" % (chipId),
+        "flashChipId": "%08X" % (flashChipId),
+        "flashChipSize": flashChipSize,
+        "flashChipSpeed": flashChipSpeed,
+        "freeHeap": freeHeap,
+        "cardDatabaseSize": cardDatabaseSize,
+        "millis": millis
+        }
+    return output
+
+def decode_status(data):
+    cmd, inputBits, stateBits, authState, batteryVoltage, uidLen = status_struct.unpack_from(data)
+    output = {
+        "type": "status",
+        "batteryVoltage": batteryVoltage/100.0,
+        "authState": authState,
+        "uid": None,
+        "lowPowerMode": bool(stateBits & 16),
+        "snibEnabled": bool(stateBits & 8),
+        "unlockedByExit": bool(stateBits & 4),
+        "unlockedBySnib": bool(stateBits & 2),
+        "unlockedByCard": bool(stateBits & 1),
+        "exitRequest": bool(inputBits & 2),
+        "snibPressed": bool(inputBits & 4),
+        "snibLongPressed": bool(inputBits & 8),
+        "doorOpen": bool(inputBits & 1)
+        }
+    if uidLen>0 and uidLen<=7:
+        output['uid'] = hexify(data[7:7+uidLen])
+    return output
+
+def decode_authrequest(data):
+    uidLen = ord(data[1])
+    if uidLen>0 and uidLen<=7:
+        return {
+            "type": "authrequest",
+            "uid": hexify(data[2:2+uidLen])
+        }
+
+def decode_databasedump(data):
+    slots = {}
+    unpack_from = databasedump_struct.unpack_from
+    length = len(data)
+    # entries are 10 bytes, walked by offset rather than re-slicing the packet
+    offset = 1
+    while length-offset >= 9:
+        slot, uidlen, uid = unpack_from(data, offset)
+        slots[int(slot)] = binascii.hexlify(uid[0:uidlen]).upper()
+        offset += 10
+    return {"type": "databasedump", "data": slots}
+
+def decode_variables(data):
+    # stream of variables
+    output = {"type": "variables"}
+    length = len(data)
+    offset = 1
+    while offset < length:
+        try:
+            k, v, offset = decode_var_at(data, offset)
+            output[k] = v
+        except Exception, e:
+            logging.exception("Exception while decoding %s (ignoring remaining data)" % (hexify(data[offset:], sep="-")))
+            return output
+    return output
+
+packet_decoders = {
+    chr(0): decode_hello,
+    chr(1): decode_systeminfo,
+    chr(2): decode_status,
+    chr(3): decode_authrequest,
+    chr(4): decode_databasedump,
+    chr(5): decode_variables,
+}
+
+packet_names = {
+    chr(0): "hello",
+    chr(1): "systeminfo",
+    chr(2): "status",
+    chr(3): "authrequest",
+    chr(4): "databasedump",
+    chr(5): "variables",
+}
 
 def decode_packet(data):
-    if data[0] == chr(0):
-        return {"type": "hello", "clientid": data[1:].rstrip(chr(0))}
-    elif data[0] == chr(1):
-        cmd, padding1, padding2, padding3, chipId, flashChipId, flashChipSize, flashChipSpeed, freeHeap, cardDatabaseSize, padding4, millis = struct.unpack(">BBBBIIIIIHHI", data[0:32])
-        output = {
-            "type": "systeminfo",
-            "chipId": "%08X" % (chipId),
-            "flashChipId": "%08X" % (flashChipId),
-            "flashChipSize": flashChipSize,
-            "flashChipSpeed": flashChipSpeed,
-            "freeHeap": freeHeap,
-            "cardDatabaseSize": cardDatabaseSize,
-            "millis": millis
-            }
-        return output
-    elif data[0] == chr(2):
-        cmd, inputBits, stateBits, authState, batteryVoltage, uidLen = struct.unpack(">BBBBHB", data[0:7])
-        output = {
-            "type": "status",
-            "batteryVoltage": batteryVoltage/100.0,
-            "authState": authState,
-            "uid": None,
-            "lowPowerMode": False,
-            "snibEnabled": False,
-            "unlockedByExit": False,
-            "unlockedBySnib": False,
-            "unlockedByCard": False,
-            "exitRequest": False,
-            "snibPressed": False,
-            "snibLongPressed": False,
-            "doorOpen": False
-            }
-        if stateBits & 16:
-            output["lowPowerMode"] = True
-        if stateBits & 8:
-            output["snibEnabled"] = True
-        if stateBits & 4:
-            output["unlockedByExit"] = True
-        if stateBits & 2:
-            output["unlockedBySnib"] = True
-        if stateBits & 1:
-            output["unlockedByCard"] = True
-        if inputBits & 8:
-            output["snibLongPressed"] = True
-        if inputBits & 4:
-            output["snibPressed"] = True
-        if inputBits & 2:
-            output["exitRequest"] = True
-        if inputBits & 1:
-            output["doorOpen"] = True
-        if uidLen>0 and uidLen<=7:
-            output['uid'] = hexify(data[7:7+uidLen])
-        return output
-    elif data[0] == chr(3):
-        uidLen = ord(data[1])
-        if uidLen>0 and uidLen<=7:
-            return {
-                "type": "authrequest",
-                "uid": hexify(data[2:2+uidLen])
-            }
-    elif data[0] == chr(4):
-        data2 = data[1:]
-        output = {"type": "databasedump", "data": {}}
-        while len(data2) >= 9:
-            slot, uidlen, uid = struct.unpack(">HB7s", data2[0:10])
-            #print slot, uidlen, hexify(uid, sep="-")
-            slot = int(slot)
-            uid = uid[0:uidlen]
-            output["data"][slot] = hexify(uid)
-            data2 = data2[10:]
-        return output
-    elif data[0] == chr(5):
-        # stream of variables
-        data2 = data[1:]
-        output = {"type": "variables"}
-        while len(data2) > 0:
-            try:
-                k, v, data2 = decode_var(data2)
-                output[k] = v
-            except Exception, e:
-                logging.exception("Exception while decoding %s (ignoring remaining data)" % (hexify(data2, sep="-")))
-                return output
-        return output
+    decode = packet_decoders.get(data[0])
+    if decode:
+        return decode(data)
 
 def hexify(data, sep=""):
-    output = []
-    for d in data:
-        output.append("%02X" % (struct.unpack("B", d)))
-    return sep.join(output)
+    output = binascii.hexlify(data).upper()
+    if sep:
+        return sep.join([output[i:i+2] for i in xrange(0, len(output), 2)])
+    return output
 
 def dehexify(data):
-    data2 = data
-    output = ""
-    while len(data2) > 0:
-        output = output + chr(int(data2[0:2], base=16))
-        data2 = data2[2:]
-    return output
+    return binascii.unhexlify(data)
@@ -0,0 +1,224 @@
+import collections
+import logging
+import socket
+import threading
+import time
+
+import database
+import decoder
+from stats import Stats
+from manager import Reader
+
+def urgent_packet(data):
+    """True for packets that someone is standing at a door waiting on."""
+    return data[:1] == "\x03"
+
+class PacketQueue(object):
+    """Received datagrams waiting for the main loop, with a priority lane.
+
+    Items are (readerid, addr, data, received) tuples as before. Auth
+    requests are taken ahead of everything else, so a swipe is not left
+    behind hundreds of database dumps and variables packets from readers
+    that are syncing.
+
+    get() waits without a timeout, because a timed Condition.wait() on
+    Python 2 polls with sleeps of up to 50ms. Periodic work is woken by
+    tick() instead, which makes get() return None.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.urgent = collections.deque()
+        self.bulk = collections.deque()
+        self.ticked = False
+
+    def qsize(self):
+        return len(self.urgent) + len(self.bulk)
+
+    def urgent_pending(self):
+        return len(self.urgent) > 0
+
+    def put(self, item):
+        self.put_batch([item])
+
+    def put_batch(self, items):
+        with self.lock:
+            for item in items:
+                if urgent_packet(item[2]):
+                    self.urgent.append(item)
+                else:
+                    self.bulk.append(item)
+            self.not_empty.notify()
+
+    def tick(self):
+        with self.lock:
+            self.ticked = True
+            self.not_empty.notify()
+
+    def get(self):
+        """Wait for the next item, or None after a tick()."""
+        with self.lock:
+            while not (self.urgent or self.ticked or self.bulk):
+                self.not_empty.wait()
+            if self.urgent:
+                return self.urgent.popleft()
+            if self.ticked:
+                # ahead of bulk packets, so periodic work is never starved
+                self.ticked = False
+                return None
+            return self.bulk.popleft()
+
+class Dispatcher(object):
+    """Connects datagrams from readers to their Reader objects.
+
+    Keeps track of which address each reader is talking from, creates and
+    drops Reader objects, and encodes and transmits whatever they reply.
+    transmit(payload, addr) does the actual sending so the same logic can be
+    driven by the threaded main loop or the event loop.
+    """
+
+    def __init__(self, db, transmit, client_timeout=60, reader_args=None,
+                 max_payload=decoder.DEFAULT_MAX_PAYLOAD, stats=None):
+        self.db = db
+        self.stats = stats or Stats()
+        self.transmit = transmit
+        self.client_timeout = client_timeout
+        self.max_payload = max_payload
+        self.reader_args = reader_args or {}
+        self.readers = {}
+        # addresses are the (host, port) tuples from recvfrom()
+        self.client_id2addr = {}
+        self.client_addr2id = {}
+        self.client_lastrecv = {}
+        self.client_lastsend = {}
+        self.readernotfound_timestamp = {}
+        self.stats.gauge("auth_cache_hits", lambda: self.db.auth_cache_hits)
+        self.stats.gauge("auth_cache_misses", lambda: self.db.auth_cache_misses)
+        self.stats.gauge("auth_cache_size", lambda: len(self.db.auth_cache))
+        scheduler = self.reader_args.get("sync_scheduler")
+        if scheduler is not None:
+            self.stats.gauge("sync_active", lambda: len(scheduler.active))
+            self.stats.gauge("sync_queued", scheduler.qsize)
+
+    def identify(self, data, addr, now=None):
+        """Return the reader id for a datagram, learning it from hello packets."""
+        if len(data) > 1:
+            if data[0] == "\x00":
+                clientid = data[1:].rstrip("\x00")
+                old = self.client_id2addr.get(clientid)
+                if old is not None and old != addr:
+                    self.client_addr2id.pop(old, None)
+                self.client_id2addr[clientid] = addr
+                self.client_addr2id[addr] = clientid
+        clientid = self.client_addr2id.get(addr)
+        if clientid is not None:
+            if now is None:
+                now = time.time()
+            self.client_lastrecv[clientid] = now
+        else:
+            self.stats.incr("unidentified_packets")
+        return clientid
+
+    def get_reader(self, readerid, addr):
+        if not self.readers.has_key(readerid):
+            try:
+                self.readers[readerid] = Reader(readerid, self.db, addr, **self.reader_args)
+            except database.ReaderNotFound:
+                self.stats.incr("unknown_readers")
+                if time.time() - self.readernotfound_timestamp.get(readerid, 0) > 300:
+                    logging.info("Unknown reader %s, ignoring" % (readerid))
+                    self.readernotfound_timestamp[readerid] = time.time()
+                return None
+        return self.readers[readerid]
+
+    def packet(self, readerid, addr, data, received=None):
+        """Handle one datagram; received is when it came off the socket."""
+        packet_type = decoder.packet_names.get(data[:1], "unknown")
+        self.stats.incr("packets_in")
+        if received is not None:
+            self.stats.observe("queue", packet_type, time.time()-received)
+        reader = self.get_reader(readerid, addr)
+        if reader is None:
+            return None
+        reader.addr = addr
+        t0 = time.time()
+        try:
+            decoded = decoder.decode_packet(data)
+        except Exception:
+            self.stats.incr("decode_errors")
+            logging.exception("%s: unable to decode %s" % (readerid, decoder.hexify(data, sep="-")))
+            return reader
+        t1 = time.time()
+        self.stats.observe("decode", packet_type, t1-t0)
+        #logging.debug("%s > %s" % (readerid, decoder.hexify(data, sep="-")))
+        if decoded:
+            logging.debug("FROM %s %s:%s %s" % (readerid, addr[0], addr[1], decoded["type"]))
+            responses = reader.event(decoded["type"], decoded)
+            self.stats.observe("event", packet_type, time.time()-t1)
+            self.send(reader, responses)
+            if received is not None and responses:
+                # from the socket to the reply being sent
+                self.stats.observe("reply", packet_type, time.time()-received)
+            self.service(reader)
+        else:
+            self.stats.incr("decode_errors")
+        return reader
+
+    def send(self, reader, responses):
+        addr = reader.addr
+        for response in responses:
+            t0 = time.time()
+            encoded_responses = decoder.encode_packets(response, self.max_payload)
+            t1 = time.time()
+            self.stats.observe("encode", response["type"], t1-t0)
+            for encoded_response in encoded_responses:
+                #logging.debug("%s < %s" % (reader.readerid, decoder.hexify(encoded_response, sep="-")))
+                logging.debug("TO %s %s:%s" % (reader.readerid, addr[0], addr[1]))
+                self.client_lastsend[reader.readerid] = time.time()
+                try:
+                    self.transmit(encoded_response, addr)
+                    self.stats.incr("packets_out")
+                except socket.error:
+                    self.stats.incr("send_errors")
+                    logging.exception("Error transmitting packet")
+            self.stats.observe("send", response["type"], time.time()-t1)
+
+    def service(self, reader, now=None):
+        """Run outgoing() for a reader if it has anything to do."""
+        if reader.pending(now):
+            t0 = time.time()
+            self.send(reader, reader.outgoing())
+            self.stats.observe("outgoing", "all", time.time()-t0)
+
+    def service_all(self, now=None):
+        if now is None:
+            now = time.time()
+        for reader in self.readers.values():
+            self.service(reader, now)
+
+    def idle(self, readerid, now=None):
+        if now is None:
+            now = time.time()
+        return now-self.client_lastrecv.get(readerid, 0) > self.client_timeout
+
+    def remove_reader(self, readerid):
+        reader = self.readers.pop(readerid, None)
+        if reader is not None:
+            reader.release_sync()
+
+    def drop(self, readerid):
+        logging.info("%s: idle connection dropped" % (readerid))
+        addr = self.client_id2addr.pop(readerid, None)
+        self.remove_reader(readerid)
+        self.client_lastrecv.pop(readerid, None)
+        self.client_lastsend.pop(readerid, None)
+        if addr is not None:
+            self.client_addr2id.pop(addr, None)
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.time()
+        for readerid in self.client_lastrecv.keys():
+            if self.idle(readerid, now):
+                self.drop(readerid)
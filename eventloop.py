@@ -0,0 +1,204 @@
+import errno
+import heapq
+import itertools
+import logging
+import os
+import select
+import socket
+import time
+
+class Timer(object):
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class EventLoop(object):
+    """A small select() based event loop with deadline timers.
+
+    File objects are registered with a callback that runs when they become
+    readable, or writable. Timers run at their deadline rather than at the
+    next poll.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.writers = {}
+        self.timers = []
+        self.sequence = itertools.count()
+        self.running = False
+
+    def add_reader(self, fileobj, callback, *args):
+        self.handlers[fileobj.fileno()] = (fileobj, callback, args)
+
+    def remove_reader(self, fileobj):
+        self.handlers.pop(fileobj.fileno(), None)
+
+    def add_writer(self, fileobj, callback, *args):
+        self.writers[fileobj.fileno()] = (fileobj, callback, args)
+
+    def remove_writer(self, fileobj):
+        self.writers.pop(fileobj.fileno(), None)
+
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, callback, args)
+        heapq.heappush(self.timers, (when, self.sequence.next(), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.time()+delay, callback, *args)
+
+    def _run_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            when, seq, timer = heapq.heappop(self.timers)
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logging.exception("Error in timer callback %r" % (timer.callback))
+
+    def _timeout(self):
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return None
+        return max(0, self.timers[0][0]-time.time())
+
+    def run_once(self):
+        try:
+            readable, writable, exceptional = select.select(self.handlers.keys(), self.writers.keys(), [], self._timeout())
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fds, handlers in [(readable, self.handlers), (writable, self.writers)]:
+            for fd in fds:
+                handler = handlers.get(fd)
+                if handler is None:
+                    continue
+                fileobj, callback, args = handler
+                try:
+                    callback(*args)
+                except Exception:
+                    logging.exception("Error in callback %r" % (callback))
+        self._run_timers()
+
+    def run_forever(self):
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        self.running = False
+
+class UnixLineServer(object):
+    """Non-blocking line based Unix stream socket server.
+
+    handler(line) returns an iterable of reply lines for each received line.
+    Replies are buffered and written as the client accepts them, so a slow
+    client never holds up the loop; one that lets more than max_output
+    bytes pile up is disconnected.
+    """
+
+    max_output = 1024*1024
+
+    def __init__(self, loop, path, handler):
+        self.loop = loop
+        self.handler = handler
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(5)
+        self.sock.setblocking(0)
+        self.buffers = {}
+        self.output = {}
+        # connections to close once their output is written
+        self.closing = set()
+        loop.add_reader(self.sock, self._accept)
+
+    def _accept(self):
+        try:
+            conn, addr = self.sock.accept()
+        except socket.error:
+            return
+        conn.setblocking(0)
+        self.buffers[conn] = ""
+        self.loop.add_reader(conn, self._read, conn)
+
+    def _close(self, conn):
+        self.loop.remove_reader(conn)
+        self.loop.remove_writer(conn)
+        self.buffers.pop(conn, None)
+        self.output.pop(conn, None)
+        self.closing.discard(conn)
+        conn.close()
+
+    def _write(self, conn, data):
+        pending = self.output.get(conn, "")
+        if len(pending)+len(data) > self.max_output:
+            logging.warning("command client not reading its replies, disconnecting")
+            self._close(conn)
+            return
+        self.output[conn] = pending + data
+        if not pending:
+            self._flush(conn)
+
+    def _flush(self, conn):
+        data = self.output[conn]
+        try:
+            sent = conn.send(data)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                sent = 0
+            else:
+                self._close(conn)
+                return
+        data = data[sent:]
+        self.output[conn] = data
+        if data:
+            self.loop.add_writer(conn, self._flush, conn)
+        else:
+            self.loop.remove_writer(conn)
+            if conn in self.closing:
+                self._close(conn)
+
+    def _read(self, conn):
+        try:
+            data = conn.recv(4096)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ""
+        if data == "":
+            self._close(conn)
+            return
+        buf = self.buffers[conn] + data
+        while "\n" in buf:
+            line, buf = buf.split("\n", 1)
+            line = line.strip()
+            if line == "":
+                self._close_when_flushed(conn)
+                return
+            logging.info("cmd> %s" % (line))
+            replies = "".join([reply+"\r\n" for reply in self.handler(line)])
+            if replies:
+                self._write(conn, replies)
+                if not self.output.has_key(conn):
+                    # disconnected
+                    return
+        self.buffers[conn] = buf
+
+    def _close_when_flushed(self, conn):
+        if self.output.get(conn):
+            self.loop.remove_reader(conn)
+            self.closing.add(conn)
+        else:
+            self._close(conn)
@@ -1,99 +1,243 @@
-import copy
+import hashlib
 import logging
+import random
 import time
 import pprint
 
 class Syncer(object):
 
+    slots_per_section = 64
+    # gaps this small between missing ranges are re-requested rather than
+    # costing another databaserequest packet
+    range_merge_gap = 8
+
     def __init__(self):
         self.slots = 0
         self.uids = []
         self.reader_data = {}
+        self.received = bytearray()
+        self.received_count = 0
+        self.sections = {}
+        self.dump_started = None
+        self.last_writes = 0
 
     def clear(self):
         self.reader_data = {}
 
     def setSlots(self, slots):
         self.slots = slots
-        #self.sections = {}
-        #for section in range(0, self.slots/self.slots_per_packet):
-        #    self.sections[section] = {
-        #        "start": section*self.slots_per_packet,
-        #        "end": ((section+1)*self.slots_per_packet)-1,
-        #        "lastrequested": None,
-        #        "lastreceived": None
-        #        }
-
-    def receivedSlot(self, slot, uid):
+        self.received = bytearray(self.slots)
+        self.received_count = 0
+        self.sections = {}
+        for section in range(0, (self.slots+self.slots_per_section-1)/self.slots_per_section):
+            self.sections[section] = {
+                "start": section*self.slots_per_section,
+                "end": min((section+1)*self.slots_per_section, self.slots)-1,
+                "lastrequested": None,
+                "lastreceived": None,
+                "received": 0
+                }
+
+    def startDump(self, timestamp):
+        self.dump_started = timestamp
+        self.received = bytearray(self.slots)
+        self.received_count = 0
+        for section in self.sections.values():
+            section["received"] = 0
+        self.requested(0, self.slots-1, timestamp)
+
+    def requested(self, start, end, timestamp):
+        for section in range(start/self.slots_per_section, end/self.slots_per_section+1):
+            if self.sections.has_key(section):
+                self.sections[section]["lastrequested"] = timestamp
+
+    def receivedSlot(self, slot, uid, timestamp=None):
         self.reader_data[slot] = uid
+        if 0 <= slot < self.slots and not self.received[slot]:
+            self.received[slot] = 1
+            self.received_count += 1
+            section = self.sections[slot/self.slots_per_section]
+            section["received"] += 1
+            section["lastreceived"] = timestamp
 
     def setUids(self, uids):
         self.uids = uids
 
     def check(self):
-        missing = []
-        for slot in range(0, self.slots):
-            if not self.reader_data.has_key(slot):
-                missing.append(slot)
-        if len(missing) == 0:
-            return True
-        else:
-            return False
+        """True once every slot has been received since startDump()."""
+        return self.received_count >= self.slots
+
+    def missingRanges(self):
+        """Return (start, end) slot ranges not yet received since startDump()."""
+        ranges = []
+        for section in range(0, len(self.sections)):
+            s = self.sections[section]
+            size = s["end"]-s["start"]+1
+            if s["received"] == size:
+                continue
+            elif s["received"] == 0:
+                runs = [(s["start"], s["end"])]
+            else:
+                runs = []
+                for slot in range(s["start"], s["end"]+1):
+                    if not self.received[slot]:
+                        if runs and runs[-1][1] == slot-1:
+                            runs[-1] = (runs[-1][0], slot)
+                        else:
+                            runs.append((slot, slot))
+            for start, end in runs:
+                if ranges and start-ranges[-1][1] <= self.range_merge_gap:
+                    ranges[-1] = (ranges[-1][0], end)
+                else:
+                    ranges.append((start, end))
+        return ranges
 
     def changes(self):
-        target_data = copy.deepcopy(self.reader_data)
-        uids = copy.deepcopy(self.uids)
-
         logging.debug("changes(), %d slots" % (self.slots))
-
-        for slot in range(0, self.slots):
-            if target_data[slot] == "FFFFFFFFFFFFFF":
-                target_data[slot] = ""
-            if target_data[slot].lstrip("0") == "":
-                target_data[slot] = ""
-            if target_data[slot] in uids:
-                logging.debug("slot %s: keep %s" % (slot, target_data[slot]))
-                uids.remove(target_data[slot])
+        reader_data = self.reader_data
+        wanted = set(self.uids)
+
+        # single pass: keep the first slot holding each wanted uid, everything
+        # else is free to be reused. Free slots that hold something (a stale
+        # uid, a duplicate or an erased FF/00 pattern) need a write whatever
+        # happens, so they are reused before slots that are already blank.
+        placed = set()
+        dirty = []
+        clean = []
+        for slot in xrange(self.slots):
+            uid = reader_data[slot]
+            if uid in wanted and uid not in placed:
+                placed.add(uid)
+            elif uid == "":
+                clean.append(slot)
             else:
-                target_data[slot] = ""
+                dirty.append(slot)
+
+        # new uids go in sorted order so the same database always lands in
+        # the same slots, and existing placements are never moved
+        remaining = sorted(wanted - placed)
 
-        for slot in range(0, self.slots):
-            if len(uids) == 0:
-                logging.debug("no more uids to add")
-                break
-            if target_data[slot] == "":
-                target_data[slot] = uids.pop()
-                logging.debug("setting slot %s = %s" % (slot, target_data[slot]))
+        changed = {}
+        for slot, uid in zip(dirty + clean, remaining):
+            changed[slot] = uid
+        for slot in dirty[len(remaining):]:
+            changed[slot] = ""
 
-        if len(uids) > 0:
-            logging.warning("out of slots, uids=%r" % (uids))
+        if len(remaining) > len(dirty) + len(clean):
+            logging.warning("out of slots, uids=%r" % (remaining[len(dirty) + len(clean):]))
 
+        for slot in sorted(changed.keys()):
+            logging.info("change slot %d: %s -> %s" % (slot, reader_data[slot], changed[slot]))
+
+        # one databaseset with every change; the encoder splits it into as
+        # many datagrams as the payload size needs
         output = []
-        #for slot in range(0, self.slots):
-        #    if target_data[slot] != self.reader_data[slot]:
-        #        print "sending %s = %s" % (slot, target_data[slot])
-        #        output.append({"type": "databaseset", "slot": slot, "uid": target_data[slot]})
-
-        changelist = {}
-        for slot in range(0, self.slots):
-            if target_data[slot] != self.reader_data[slot]:
-                changelist[slot] = target_data[slot]
-                logging.info("change slot %d: %s -> %s" % (slot, self.reader_data[slot], target_data[slot]))
-                if len(changelist.keys()) >= 128:
-                    output.append({"type": "databaseset", "slots": changelist})
-                    changelist = {}
-
-        if len(changelist.keys()) > 0:
-            output.append({"type": "databaseset", "slots": changelist})
-
-        logging.debug("changes() returning %r" % (output))
+        if len(changed) > 0:
+            output.append({"type": "databaseset", "slots": changed})
+
+        self.last_writes = len(changed)
+        logging.debug("changes() returning %r", output)
         return output
 
+class SyncScheduler(object):
+    """Limits how many readers may be syncing at once.
+
+    A reader asks for a slot before requesting a database dump and holds
+    it until the sync finishes, including the verifying re-dump. Waiting
+    readers become eligible after a random delay of up to jitter seconds,
+    so a reload or a mass reconnect does not start every dump in the same
+    pass. Readers that have handled an auth in the last auth_priority
+    seconds go ahead of the rest. max_concurrent 0 means no limit.
+    """
+
+    # how often a waiting reader checks its place in the queue
+    recheck_interval = 1.0
+
+    def __init__(self, max_concurrent=4, jitter=5.0, auth_priority=300):
+        self.max_concurrent = max_concurrent
+        self.jitter = jitter
+        self.auth_priority = auth_priority
+        self.active = set()
+        # readerid -> (time it may start, reader)
+        self.waiting = {}
+        self.order = None
+        self.order_time = None
+
+    def per_shard(self, shards):
+        """A scheduler for one of shards workers, sharing out the limit."""
+        max_concurrent = self.max_concurrent
+        if max_concurrent:
+            max_concurrent = max(1, (max_concurrent+shards-1)/shards)
+        return SyncScheduler(max_concurrent, self.jitter, self.auth_priority)
+
+    def _order(self, now):
+        """{readerid: (queue position, position among those ready to start)}"""
+        if self.order is None or now-self.order_time >= self.recheck_interval:
+            def key(readerid):
+                ready_time, reader = self.waiting[readerid]
+                recent = reader.last_auth is not None and now-reader.last_auth < self.auth_priority
+                return (not recent, ready_time)
+            self.order = {}
+            ready = 0
+            for position, readerid in enumerate(sorted(self.waiting.keys(), key=key)):
+                self.order[readerid] = (position+1, ready)
+                if self.waiting[readerid][0] <= now:
+                    ready += 1
+            self.order_time = now
+        return self.order
+
+    def request(self, reader, now):
+        """0 if reader may start syncing, otherwise its place in the queue."""
+        readerid = reader.readerid
+        if readerid in self.active:
+            return 0
+        if not self.waiting.has_key(readerid):
+            self.waiting[readerid] = (now+random.uniform(0, self.jitter), reader)
+            self.order = None
+        ready_time = self.waiting[readerid][0]
+        position, ready_position = self._order(now).get(readerid, (len(self.waiting), None))
+        if ready_time <= now and ready_position is not None:
+            if not self.max_concurrent or ready_position < self.max_concurrent-len(self.active):
+                del self.waiting[readerid]
+                self.active.add(readerid)
+                self.order = None
+                return 0
+        return position
+
+    def next_check(self, reader, now):
+        ready_time = self.waiting[reader.readerid][0]
+        if ready_time > now:
+            return ready_time
+        return now+self.recheck_interval
+
+    def release(self, readerid):
+        """readerid has finished syncing, or gone away."""
+        self.waiting.pop(readerid, None)
+        if readerid in self.active:
+            self.active.discard(readerid)
+            # let the readers next in line try straight away
+            for ready_time, reader in self.waiting.values():
+                reader.dirty = True
+        self.order = None
+
+    def qsize(self):
+        return len(self.waiting)
+
 class Reader(object):
 
+    sync_timeout = 10
+    sync_max_timeout = 60
+    sync_max_retries = 5
+    # allowance for clock drift when comparing millis with a saved state
+    restore_millis_slack = 5000
+    # how long to wait for the variables the saved state is checked against
+    restore_wait = 10
+    restore_vars = ["cardDatabaseSize", "chipId", "millis", "eepromChangesPending"]
+
     def __init__(self, readerid, database, addr,
                  sync_interval=3600, amqp_outbound=None, auth_logger=None,
-                 token_sighting_queue=None, send_anonymous=False, mqtt_outbound=None):
+                 token_sighting_queue=None, send_anonymous=False, mqtt_outbound=None,
+                 state_store=None, sync_scheduler=None):
         self.readerid = readerid
         self.database = database
         self.addr = addr
@@ -103,8 +247,10 @@ class Reader(object):
         self.auth_logger = auth_logger
         self.token_sighting_queue = token_sighting_queue
         self.send_anonymous = send_anonymous
+        self.state_store = state_store
+        self.sync_scheduler = sync_scheduler
 
-        self.database_timestamp = self.database.timestamp()
+        self.database_generation = self.database.reader_generation(readerid)
         self.reader_name = self.database.reader_name(readerid)
         self.mqtt_readerid = self.database.reader_id(readerid)
 
@@ -112,13 +258,24 @@ class Reader(object):
         self.vars = {}
         self.var_timestamps = {}
         self.cards = {}
-        self.card_timestamps = {}
         self.door_state = "unknown"
 
+        # set whenever outgoing() may have something to do; the controller
+        # skips readers that are neither dirty nor past their deadline()
+        self.dirty = True
         self.sync_scheduled = True
         self.sync_waiting_for_data_since = None
+        self.sync_last_request = None
+        self.sync_retries = 0
         self.sync_changes_pending = False
         self.send_amqp_status = False
+        self.last_auth = None
+        self.sync_queue_check = None
+        self.sync_queue_position = None
+        self.saved_state = None
+        if self.state_store:
+            self.saved_state = self.state_store.load(readerid)
+        self.restore_deadline = time.time()+self.restore_wait
 
         logging.info("%s: connected from %s:%s" % (readerid, addr[0], addr[1]))
         if self.mqtt_outbound:
@@ -128,6 +285,107 @@ class Reader(object):
         if self.mqtt_outbound:
             self.mqtt_outbound.put(("%s/connected" % (self.mqtt_readerid), False, True))
 
+    def schedule_sync(self):
+        self.sync_scheduled = True
+        self.dirty = True
+
+    def _sync_slot(self):
+        """True if the scheduler lets this reader start a sync now."""
+        if not self.sync_scheduler:
+            return True
+        now = time.time()
+        position = self.sync_scheduler.request(self, now)
+        if position == 0:
+            self.sync_queue_check = None
+            self.sync_queue_position = None
+            return True
+        self.sync_queue_check = self.sync_scheduler.next_check(self, now)
+        if position != self.sync_queue_position:
+            if self.sync_queue_position is None:
+                logging.info("%s: sync - queued behind other readers" % (self.readerid))
+                self.send_mqtt("sync", "queued")
+            self.send_mqtt("sync/position", position)
+            self.sync_queue_position = position
+        return False
+
+    def release_sync(self):
+        """Give up this reader's place with the sync scheduler."""
+        if self.sync_scheduler:
+            self.sync_scheduler.release(self.readerid)
+        self.sync_queue_check = None
+        self.sync_queue_position = None
+
+    def _cards_digest(self, uids):
+        return hashlib.sha1("\n".join(sorted(uids))).hexdigest()
+
+    def _save_state(self):
+        if self.state_store:
+            self.state_store.save(self.readerid, {
+                "chipId": self.vars.get("chipId"),
+                "millis": self.vars.get("millis"),
+                "millis_time": self.var_timestamps.get("millis"),
+                "slots": self.syncer.slots,
+                "cards_digest": self._cards_digest(self.syncer.uids),
+                "cards": dict([(slot, uid) for slot, uid in self.syncer.reader_data.items() if slot < self.syncer.slots]),
+                })
+
+    def _restore_state(self, saved):
+        """Take the saved card image instead of a dump if it is still valid."""
+        slots = self.vars["cardDatabaseSize"]
+        uids = self.database.cards_for_reader(self.readerid)
+        # not knowing is as bad as changes pending
+        if self.vars.get("eepromChangesPending", True):
+            reason = "eeprom changes pending"
+        elif saved["chipId"] is None or saved["chipId"] != self.vars.get("chipId"):
+            reason = "different chip"
+        elif saved["slots"] != slots or len(saved["cards"]) != slots:
+            reason = "database size changed"
+        elif saved["millis"] is None or self.var_timestamps.get("millis") is None:
+            reason = "uptime unknown"
+        elif saved["cards_digest"] != self._cards_digest(uids):
+            reason = "card list changed"
+        else:
+            elapsed = (self.var_timestamps["millis"]-saved["millis_time"])*1000
+            expected = saved["millis"]+elapsed
+            if expected >= 2**32:
+                reason = "uptime counter may have wrapped"
+            elif self.vars["millis"] < saved["millis"] or self.vars["millis"] < expected-self.restore_millis_slack-elapsed/100:
+                reason = "reader has restarted"
+            else:
+                reason = None
+        if reason:
+            logging.info("%s: sync - not using saved card image (%s)" % (self.readerid, reason))
+            return False
+        self.syncer.setSlots(slots)
+        self.syncer.setUids(uids)
+        for slot, uid in saved["cards"].items():
+            self.cards[slot] = uid
+            self.syncer.receivedSlot(slot, uid)
+        self.database_generation = self.database.reader_generation(self.readerid)
+        logging.info("%s: sync - using saved card image, no dump needed" % (self.readerid))
+        return True
+
+    def deadline(self):
+        """Time at which outgoing() must run even without new events."""
+        if self.sync_waiting_for_data_since:
+            return self.sync_last_request + min(self.sync_timeout * 2**self.sync_retries, self.sync_max_timeout)
+        if self.saved_state is not None:
+            return self.restore_deadline
+        return self.sync_queue_check
+
+    def pending(self, now=None):
+        """True if outgoing() has any work to do."""
+        if self.dirty:
+            return True
+        if self.database.reader_generation(self.readerid) > self.database_generation:
+            return True
+        deadline = self.deadline()
+        if deadline is not None:
+            if now is None:
+                now = time.time()
+            return now >= deadline
+        return False
+
     def send_mqtt(self, topic, payload, retain=True):
         if self.mqtt_outbound:
             self.mqtt_outbound.put(("%s/%s" % (self.mqtt_readerid, topic), payload, retain))
@@ -193,6 +451,7 @@ class Reader(object):
                     self.door_state = new_door_state
         if k == "authState":
             if vnew in ["local-granted", "local-denied", "network-granted", "network-denied"]:
+                self.last_auth = time.time()
                 uid = self.vars.get("authUid", None)
                 authorized, name, token_name, private = self.database.auth(self.readerid, uid)
                 message = {
@@ -245,8 +504,10 @@ class Reader(object):
                 # new millis is less than old value
                 # assume that a restart has occurred
                 # trigger database refresh
-                self.sync_scheduled = True
+                self.schedule_sync()
                 logging.info("%s: restart detected, scheduling a sync" % (self.readerid))
+        if k == "cardDatabaseSize":
+            self.dirty = True
         if k in ["snibUnlockActive", "doorState"]:
             self.send_amqp_status = True
         #if vold is None:
@@ -257,6 +518,7 @@ class Reader(object):
 
     def event_authrequest(self, data):
         uid = data['uid']
+        self.last_auth = time.time()
         authorized, name, token, private = self.database.auth(self.readerid, uid)
         if authorized:
             return [{"type": "authresponse", "authorized": True, "uid": uid}]
@@ -264,13 +526,16 @@ class Reader(object):
             return [{"type": "authresponse", "authorized": False, "uid": uid}]
 
     def event_databasedump(self, data):
+        now = time.time()
         for slot, uid in data["data"].items():
             self.cards[slot] = uid
-            self.card_timestamps[slot] = time.time()
-            self.syncer.receivedSlot(slot, uid)
+            self.syncer.receivedSlot(slot, uid, now)
+        if self.sync_waiting_for_data_since and self.syncer.check():
+            self.dirty = True
         return []
 
     def outgoing(self):
+        self.dirty = False
         #for k in sorted(self.vars.keys()):
         #    print "%s=%s" % (k, self.vars[k]),
         #print
@@ -280,41 +545,59 @@ class Reader(object):
         #        print "%s" % (self.cards[k]),
         #print
 
-        if self.database.timestamp() > self.database_timestamp:
+        if self.database.reader_generation(self.readerid) > self.database_generation:
             if self.sync_scheduled is False:
-                logging.info("%s: database has been reloaded, scheduling a sync" % (self.readerid))
-                self.sync_scheduled = True
+                logging.info("%s: card list has changed, scheduling a sync" % (self.readerid))
+                self.schedule_sync()
                 self.send_mqtt("sync", "check")
 
         #if time.time()-self.lastDatabaseRequest > self.sync_interval and self.sync_requested is False:
         #    logging.info("%s: last sync was more than %s seconds ago, scheduling another sync" % (self.readerid, self.sync_interval))
         #    self.sync_scheduled = time.time()
 
+        if self.saved_state is not None:
+            # decide on the saved image only once everything it is checked
+            # against has been reported; until then there is no dump either
+            if not self.sync_scheduled:
+                self.saved_state = None
+            elif len([k for k in self.restore_vars if self.vars.has_key(k)]) == len(self.restore_vars):
+                saved = self.saved_state
+                self.saved_state = None
+                if self._restore_state(saved):
+                    self.sync_scheduled = False
+                    self.send_mqtt("sync", "uptodate")
+            elif time.time() >= self.restore_deadline:
+                logging.info("%s: sync - not using saved card image (missing %s)" % (self.readerid, ", ".join([k for k in self.restore_vars if not self.vars.has_key(k)])))
+                self.saved_state = None
+
         if self.vars.has_key("cardDatabaseSize"):
-            if self.sync_scheduled:
+            if self.sync_scheduled and self.saved_state is None and self._sync_slot():
                 self.syncer.setSlots(self.vars["cardDatabaseSize"])
                 self.lastDatabaseRequest = time.time()
-                self.database_timestamp = self.database.timestamp()
+                self.syncer.startDump(self.lastDatabaseRequest)
+                self.database_generation = self.database.reader_generation(self.readerid)
                 logging.info("%s: sync - requesting database from reader" % (self.readerid))
                 yield {"type": "databaserequest", "start": 0, "end": self.vars["cardDatabaseSize"]-1}
                 self.sync_waiting_for_data_since = time.time()
+                self.sync_last_request = self.sync_waiting_for_data_since
+                self.sync_retries = 0
                 self.sync_scheduled = False
                 self.send_mqtt("sync", "waitingfordata")
                 #self.sync_requested = False
                 #self.sync_in_progress = True
 
             if self.sync_waiting_for_data_since:
-                waiting = False
-                for slot in range(0, self.vars["cardDatabaseSize"]):
-                    if self.card_timestamps.get(slot, 0) < self.lastDatabaseRequest:
-                        waiting = True
-                if waiting is False:
+                if self.syncer.check():
                     logging.info("%s: sync - all data received from reader" % (self.readerid))
                     self.sync_waiting_for_data_since = None
                     #print "sync: sending changes"
                     changes = 0
                     self.syncer.setUids(self.database.cards_for_reader(self.readerid))
                     changelist = self.syncer.changes()
+                    self.send_mqtt("sync/writes", self.syncer.last_writes)
+                    if len(changelist) > 0 and self.state_store:
+                        # the saved image no longer matches the reader
+                        self.state_store.remove(self.readerid)
                     if len(changelist) > 0:
                         self.send_mqtt("sync", "sendingchanges")
                         for response in changelist:
@@ -326,7 +609,7 @@ class Reader(object):
                     #self.sync_in_progress = False
                     if changes > 0:
                         logging.info("%s: sync - %s change(s) made, scheduling re-sync to verify" % (self.readerid, changes))
-                        self.sync_scheduled = True
+                        self.schedule_sync()
                         self.sync_changes_pending = True
                         self.send_mqtt("sync", "verifying")
                     else:
@@ -336,10 +619,24 @@ class Reader(object):
                             self.sync_changes_pending = False
                         else:
                             logging.info("%s: sync - 0 changes made" % (self.readerid))
+                        self.release_sync()
+                        self._save_state()
                         self.send_mqtt("sync", "uptodate")
                     #print "sync: %d changes sent" % (changes)
                 else:
-                    if time.time()-self.sync_waiting_for_data_since > 10:
-                        logging.warning("%s: sync - timeout waiting for data from reader, scheduling a new sync" % (self.readerid))
-                        self.sync_scheduled = True
-                        self.send_mqtt("sync", "check")
+                    if time.time() >= self.deadline():
+                        if self.sync_retries >= self.sync_max_retries:
+                            logging.warning("%s: sync - timeout waiting for data from reader after %d retries, scheduling a new sync" % (self.readerid, self.sync_retries))
+                            self.sync_waiting_for_data_since = None
+                            self.release_sync()
+                            self.schedule_sync()
+                            self.send_mqtt("sync", "failed")
+                        else:
+                            self.sync_retries += 1
+                            self.sync_last_request = time.time()
+                            ranges = self.syncer.missingRanges()
+                            logging.warning("%s: sync - timeout waiting for data from reader, re-requesting %d range(s) (retry %d)" % (self.readerid, len(ranges), self.sync_retries))
+                            self.send_mqtt("sync", "rerequesting")
+                            for start, end in ranges:
+                                self.syncer.requested(start, end, self.sync_last_request)
+                                yield {"type": "databaserequest", "start": start, "end": end}
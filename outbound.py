@@ -0,0 +1,202 @@
+import Queue
+import collections
+import itertools
+import threading
+import time
+
+class OutboundQueue(object):
+    """Bounded queue between the readers and a publisher thread.
+
+    Items are the same tuples that were put on the old Queue.Queue. key(item)
+    returns a coalescing key (e.g. the topic of a retained message) or None;
+    a queued item with the same key is replaced by the newer one, keeping
+    its place in the queue, so a broker outage leaves one value per topic
+    instead of every intermediate one. urgent(item) marks events such as
+    swipes, which are sent ahead of everything else and are the last to be
+    dropped when the queue is full; otherwise the oldest item is dropped.
+
+    With a spool, urgent items are written to disk instead of being held
+    in memory, are never dropped, and survive a restart. The consumer then
+    calls ack(n) once the first n items of the last batch are delivered.
+    """
+
+    def __init__(self, maxsize=10000, key=None, urgent=None, spool=None):
+        self.maxsize = maxsize
+        self.key = key or (lambda item: None)
+        self.urgent = urgent or (lambda item: False)
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.urgent_items = collections.deque()
+        self.items = collections.OrderedDict()
+        self.sequence = itertools.count()
+        self.spool = spool
+        self.spooled = []
+        if spool:
+            spool.notify = self._spool_notify
+        self.dropped = 0
+        self.coalesced = 0
+
+    def qsize(self):
+        with self.lock:
+            size = len(self.urgent_items) + len(self.items)
+        if self.spool:
+            size += self.spool.qsize()
+        return size
+
+    def _spool_notify(self):
+        with self.lock:
+            self.not_empty.notify()
+
+    def _empty(self):
+        if self.urgent_items or self.items:
+            return False
+        return not (self.spool and self.spool.readable())
+
+    def put(self, item, block=True, timeout=None):
+        if self.spool and self.urgent(item):
+            self.spool.put(item)
+            return
+        with self.lock:
+            if self.urgent(item):
+                self.urgent_items.append(item)
+            else:
+                key = self.key(item)
+                if key is None:
+                    key = self.sequence.next()
+                elif self.items.has_key(key):
+                    self.coalesced += 1
+                self.items[key] = item
+            self._trim()
+            self.not_empty.notify()
+
+    def _trim(self):
+        while len(self.urgent_items) + len(self.items) > self.maxsize:
+            if self.items:
+                self.items.popitem(last=False)
+            else:
+                self.urgent_items.popleft()
+            self.dropped += 1
+
+    def _wait(self, block, timeout):
+        if not block:
+            if self._empty():
+                raise Queue.Empty
+        elif timeout is None:
+            while self._empty():
+                self.not_empty.wait()
+        else:
+            deadline = time.time()+timeout
+            while self._empty():
+                remaining = deadline-time.time()
+                if remaining <= 0:
+                    raise Queue.Empty
+                self.not_empty.wait(remaining)
+
+    def _pop(self):
+        if self.urgent_items:
+            return self.urgent_items.popleft()
+        return self.items.popitem(last=False)[1]
+
+    def get(self, block=True, timeout=None):
+        if self.spool:
+            # single items are acknowledged as soon as they are taken
+            if not block:
+                timeout = 0
+            item = self.get_batch(1, timeout)[0]
+            self.ack(1)
+            return item
+        with self.lock:
+            self._wait(block, timeout)
+            return self._pop()
+
+    def get_batch(self, max_items=100, timeout=None):
+        """Wait for at least one item and return up to max_items of them."""
+        with self.lock:
+            self._wait(True, timeout)
+        batch = []
+        self.spooled = []
+        if self.spool:
+            self.spooled = self.spool.read(max_items)
+            batch = [item for position, item in self.spooled]
+        with self.lock:
+            while len(batch) < max_items and (self.urgent_items or self.items):
+                batch.append(self._pop())
+        return batch
+
+    def ack(self, n):
+        """The first n items of the last batch have been delivered."""
+        n = min(n, len(self.spooled))
+        if n > 0:
+            self.spool.ack(self.spooled[n-1][0], n)
+        self.spooled = self.spooled[n:]
+
+    def deliver(self, batch, send):
+        """Call send(item) for each item of batch, in order.
+
+        If send raises, whatever went out is acknowledged and the rest is
+        returned with unget(), where it is subject to the size limit while
+        the destination is away, and the exception is re-raised.
+        """
+        for n, item in enumerate(batch):
+            try:
+                send(item)
+            except Exception:
+                self.ack(n)
+                self.unget(batch[n:])
+                raise
+        self.ack(len(batch))
+
+    def unget(self, items):
+        """Return items that could not be published to the front of the queue.
+
+        A newer value already queued for the same key wins over the returned
+        one. The size limit is applied as in put(). Spooled items are read
+        from the spool again instead.
+        """
+        if self.spool:
+            items = items[len(self.spooled):]
+            self.spooled = []
+            self.spool.rewind()
+        with self.lock:
+            requeued = collections.OrderedDict()
+            for item in items:
+                if self.urgent(item):
+                    continue
+                key = self.key(item)
+                if key is None:
+                    key = self.sequence.next()
+                elif self.items.has_key(key):
+                    continue
+                requeued[key] = item
+            requeued.update(self.items)
+            self.items = requeued
+            self.urgent_items.extendleft(reversed([item for item in items if self.urgent(item)]))
+            self._trim()
+            self.not_empty.notify()
+
+def mqtt_key(item):
+    topic, data, retain = item
+    if retain:
+        return topic
+    return None
+
+def mqtt_urgent(item):
+    topic, data, retain = item
+    return topic.endswith("/auth")
+
+def amqp_urgent(item):
+    topic, payload = item
+    return topic == "door.swipe"
+
+class FanoutQueue(object):
+    """Puts a copy of each item on several queues, one per destination."""
+
+    def __init__(self, queues):
+        self.queues = queues
+
+    def put(self, item, block=True, timeout=None):
+        for q in self.queues:
+            q.put(item, block, timeout)
+
+    def qsize(self):
+        return max([q.qsize() for q in self.queues])
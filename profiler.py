@@ -0,0 +1,152 @@
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import thread
+import threading
+import time
+
+class ProfilerError(Exception):
+    pass
+
+class _Snapshot(object):
+    """Finished profile data in the form pstats.Stats accepts."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+class Profiler(object):
+    """Profiles a running process on demand.
+
+    cprofile mode attaches a cProfile.Profile to each thread that calls
+    tick(); cProfile only hooks the thread that enables it, so every loop
+    that should be covered calls tick() once per iteration. The per-thread
+    profiles are merged into one pstats file on stop; other threads'
+    profiles are read as they stand and detach on their next tick.
+
+    sample mode runs a background thread that records the stacks of all
+    threads every interval seconds and writes them in collapsed-stack
+    format (one "frame;frame;frame count" line per distinct stack), which
+    is cheap enough to leave running on a busy controller.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mode = None
+        self.session = 0
+        self.started = None
+        self.active = {}
+        self.finished = []
+        self.sampler = None
+        self.sampler_stop = None
+        self.samples = {}
+        self.sample_count = 0
+
+    def start(self, mode="cprofile", interval=0.01):
+        with self.lock:
+            if self.mode is not None:
+                raise ProfilerError("Profiler already running (%s)" % (self.mode))
+            if mode not in ["cprofile", "sample"]:
+                raise ProfilerError("Unknown profiler mode %s" % (mode))
+            self.mode = mode
+            self.session += 1
+            self.started = time.time()
+            self.finished = []
+            self.samples = {}
+            self.sample_count = 0
+        logging.info("profiler started (%s)" % (mode))
+        if mode == "sample":
+            self.sampler_stop = threading.Event()
+            self.sampler = threading.Thread(target=self._sample_loop, args=(interval, self.sampler_stop))
+            self.sampler.daemon = True
+            self.sampler.start()
+        else:
+            self.tick()
+
+    def tick(self):
+        """Attach or detach the calling thread's profile as needed."""
+        if not self.active and self.mode != "cprofile":
+            return
+        ident = thread.get_ident()
+        current = self.active.get(ident)
+        if current is not None and (self.mode != "cprofile" or current[1] != self.session):
+            with self.lock:
+                del self.active[ident]
+            profile, session = current
+            profile.disable()
+            profile.create_stats()
+            with self.lock:
+                if session == self.session:
+                    self.finished.append(profile)
+            current = None
+        if current is None and self.mode == "cprofile":
+            profile = cProfile.Profile()
+            with self.lock:
+                self.active[ident] = (profile, self.session)
+            profile.enable()
+
+    def stop(self, path):
+        """Stop profiling and write the results to path."""
+        with self.lock:
+            mode = self.mode
+            if mode is None:
+                raise ProfilerError("Profiler not running")
+            self.mode = None
+        elapsed = time.time()-self.started
+        logging.info("profiler stopped after %.1fs, writing %s" % (elapsed, path))
+        if mode == "sample":
+            self.sampler_stop.set()
+            self.sampler.join()
+            self.sampler = None
+            self._write_collapsed(path)
+            return "Wrote %d samples (%d stacks) to %s" % (self.sample_count, len(self.samples), path)
+        # profiles can only be detached by their own thread; stop() may run
+        # on the event loop, so rather than wait for the other threads to
+        # tick (some block indefinitely), read their profiles in place
+        self.tick()
+        with self.lock:
+            profiles = self.finished
+            self.finished = []
+            stragglers = [profile for profile, session in self.active.values() if session == self.session]
+        for profile in stragglers:
+            # snapshot_stats only reads the profile, unlike create_stats
+            # which would try to disable it from the wrong thread
+            profile.snapshot_stats()
+            profiles.append(profile)
+        if not profiles:
+            raise ProfilerError("No threads were profiled")
+        stats = pstats.Stats(_Snapshot(profiles[0].stats))
+        for profile in profiles[1:]:
+            stats.add(_Snapshot(profile.stats))
+        stats.dump_stats(path)
+        return "Wrote %d threads to %s" % (len(profiles), path)
+
+    def _sample_loop(self, interval, stop):
+        me = thread.get_ident()
+        while not stop.wait(interval):
+            names = dict([(t.ident, t.name) for t in threading.enumerate()])
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stack.reverse()
+                key = ";".join(stack)
+                self.samples[key] = self.samples.get(key, 0) + 1
+            self.sample_count += 1
+
+    def _write_collapsed(self, path):
+        fh = open(path, "w")
+        try:
+            for stack in sorted(self.samples.keys()):
+                fh.write("%s %d\n" % (stack, self.samples[stack]))
+        finally:
+            fh.close()
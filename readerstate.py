@@ -0,0 +1,56 @@
+import errno
+import json
+import logging
+import os
+
+class ReaderStateStore(object):
+    """Last verified card image of each reader, kept across restarts.
+
+    One JSON file per reader in directory, replaced atomically, so a crash
+    part way through a save leaves the previous state in place.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, readerid):
+        return os.path.join(self.directory, "%s.json" % (readerid.replace("/", "_")))
+
+    def load(self, readerid):
+        try:
+            fh = open(self._path(readerid))
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                logging.exception("%s: unable to read saved state" % (readerid))
+            return None
+        try:
+            state = json.load(fh)
+        except ValueError:
+            logging.warning("%s: ignoring unreadable saved state" % (readerid))
+            return None
+        finally:
+            fh.close()
+        state["cards"] = dict([(int(slot), str(uid)) for slot, uid in state["cards"].items()])
+        return state
+
+    def save(self, readerid, state):
+        path = self._path(readerid)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            fh = open(tmp, "w")
+            json.dump(state, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+            fh.close()
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            logging.exception("%s: unable to save state" % (readerid))
+
+    def remove(self, readerid):
+        try:
+            os.unlink(self._path(readerid))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,278 @@
+import Queue
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import zlib
+
+from dispatcher import Dispatcher, urgent_packet
+from profiler import Profiler, ProfilerError
+
+def shard_for(readerid, shards):
+    return zlib.crc32(readerid) % shards
+
+class QueueWriter(object):
+    """Stands in for the front end's auth logger inside a worker."""
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def write(self, data):
+        self.queue.put(data)
+
+class ShardWorker(multiprocessing.Process):
+    """Owns the Reader objects for one shard of the reader fleet.
+
+    Packets arrive on the inbound queue already identified by the front
+    end, with auth requests on a separate urgent queue that is drained
+    before each inbound message is handled; replies go back on the shared
+    replies queue for the front end to transmit from the listening socket.
+    The CardDatabase is inherited from the front end when the process
+    forks and then reloaded independently.
+    """
+
+    def __init__(self, index, db, inbound, replies, client_timeout=60, reader_args=None,
+                 database_check_interval=5, max_payload=None):
+        multiprocessing.Process.__init__(self, name="shard-%d" % (index))
+        self.index = index
+        self.db = db
+        self.inbound = inbound
+        self.urgent = multiprocessing.Queue()
+        # wake messages seen for urgent packets not yet handled
+        self.urgent_owed = 0
+        self.replies = replies
+        self.client_timeout = client_timeout
+        self.reader_args = reader_args
+        self.database_check_interval = database_check_interval
+        self.max_payload = max_payload
+        self.parent_pid = os.getpid()
+        self.daemon = True
+
+    def transmit(self, payload, addr):
+        self.replies.put(("send", payload, addr))
+
+    def run(self):
+        self.dispatcher = Dispatcher(self.db, self.transmit,
+            client_timeout=self.client_timeout, reader_args=self.reader_args,
+            max_payload=self.max_payload)
+        self.profiler = Profiler()
+        logging.info("shard %d started" % (self.index))
+        last_database_check = time.time()
+        while os.getppid() == self.parent_pid:
+            now = time.time()
+            if now-last_database_check > self.database_check_interval:
+                self.db.autoreload()
+                last_database_check = now
+            timeout = self.database_check_interval
+            for reader in self.dispatcher.readers.values():
+                deadline = reader.deadline()
+                if deadline is not None:
+                    timeout = min(timeout, max(0, deadline-now))
+            try:
+                msg = self.inbound.get(True, timeout)
+                self.handle_urgent()
+                self.handle_safely(msg)
+            except Queue.Empty:
+                pass
+            self.dispatcher.service_all()
+            self.profiler.tick()
+        logging.info("shard %d: front end has gone away, exiting" % (self.index))
+
+    def handle_safely(self, msg):
+        try:
+            self.handle(msg)
+        except Exception:
+            logging.exception("shard %d: error handling %r" % (self.index, msg[0]))
+
+    def handle_urgent(self, block=False):
+        while True:
+            try:
+                if block:
+                    # the queues have separate feeder threads, so the wake
+                    # can arrive before the packet it is for
+                    msg = self.urgent.get(True, 1)
+                else:
+                    msg = self.urgent.get_nowait()
+            except Queue.Empty:
+                return
+            self.urgent_owed -= 1
+            self.handle_safely(msg)
+            if block and self.urgent_owed <= 0:
+                return
+
+    def handle(self, msg):
+        if msg[0] == "wake":
+            self.urgent_owed += 1
+            if self.urgent_owed > 0:
+                self.handle_urgent(block=True)
+        elif msg[0] == "packet":
+            kind, readerid, addr, data, received = msg
+            self.dispatcher.packet(readerid, addr, data, received)
+        elif msg[0] == "drop":
+            self.dispatcher.remove_reader(msg[1])
+        elif msg[0] == "command":
+            kind, token, name, args = msg
+            try:
+                result = getattr(self, "cmd_%s" % (name))(*args)
+            except Exception, e:
+                logging.exception("shard %d: command %s failed" % (self.index, name))
+                result = "shard %d: %s" % (self.index, e)
+            self.replies.put(("command", token, result))
+
+    def cmd_readers(self):
+        return self.dispatcher.readers.keys()
+
+    def cmd_stats(self):
+        return self.dispatcher.stats.snapshot()
+
+    def cmd_profile_start(self, mode, interval):
+        try:
+            self.profiler.start(mode, interval)
+        except ProfilerError, e:
+            return "shard %d: %s" % (self.index, e)
+
+    def cmd_profile_stop(self, path):
+        try:
+            return self.profiler.stop(path)
+        except ProfilerError, e:
+            return "shard %d: %s" % (self.index, e)
+
+    def cmd_sync(self, readerid):
+        reader = self.dispatcher.readers.get(readerid)
+        if reader is None:
+            return False
+        reader.schedule_sync()
+        return True
+
+class ShardRouter(object):
+    """Front end side of the sharded controller.
+
+    Routes identified datagrams to the worker that owns the reader, sends
+    the workers' replies from the listening socket, and forwards what the
+    workers publish to the outbound queues served by the TX threads.
+    """
+
+    def __init__(self, shards, db, sock, client_timeout=60, reader_args=None,
+                 database_check_interval=5, max_payload=None):
+        self.sock = sock
+        self.replies = multiprocessing.Queue()
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.tokens = itertools.count()
+        self.forwards = []
+        reader_args = dict(reader_args or {})
+        if reader_args.get("sync_scheduler") is not None:
+            # forked into every worker, so each gets its share of the limit
+            reader_args["sync_scheduler"] = reader_args["sync_scheduler"].per_shard(shards)
+        for k in ["amqp_outbound", "mqtt_outbound", "token_sighting_queue", "auth_logger"]:
+            if reader_args.get(k) is not None:
+                q = multiprocessing.Queue()
+                if k == "auth_logger":
+                    self.forwards.append((q, reader_args[k].write))
+                    reader_args[k] = QueueWriter(q)
+                else:
+                    self.forwards.append((q, reader_args[k].put))
+                    reader_args[k] = q
+        self.workers = []
+        for index in range(shards):
+            worker = ShardWorker(index, db, multiprocessing.Queue(), self.replies,
+                client_timeout=client_timeout, reader_args=reader_args,
+                database_check_interval=database_check_interval, max_payload=max_payload)
+            self.workers.append(worker)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self._thread(self.reply_loop)
+        for source, destination in self.forwards:
+            self._thread(self.forward_loop, source, destination)
+
+    def _thread(self, target, *args):
+        t = threading.Thread(target=target, args=args)
+        t.daemon = True
+        t.start()
+
+    def worker(self, readerid):
+        return self.workers[shard_for(readerid, len(self.workers))]
+
+    def route(self, readerid, addr, data, received):
+        worker = self.worker(readerid)
+        msg = ("packet", readerid, addr, data, received)
+        if urgent_packet(data):
+            worker.urgent.put(msg)
+            # make sure an idle worker wakes up to look at it
+            worker.inbound.put(("wake",))
+        else:
+            worker.inbound.put(msg)
+
+    def drop(self, readerid):
+        self.worker(readerid).inbound.put(("drop", readerid))
+
+    def call(self, worker, name, *args):
+        """Run cmd_<name> on a worker and wait for its result."""
+        token = self.tokens.next()
+        event = threading.Event()
+        with self.pending_lock:
+            self.pending[token] = [event, None]
+        worker.inbound.put(("command", token, name, args))
+        event.wait(5)
+        with self.pending_lock:
+            event, result = self.pending.pop(token)
+        return result
+
+    def readers(self):
+        readers = []
+        for worker in self.workers:
+            readers.extend(self.call(worker, "readers") or [])
+        return readers
+
+    def stats(self):
+        snapshots = []
+        for worker in self.workers:
+            snapshot = self.call(worker, "stats")
+            if snapshot:
+                snapshots.append(snapshot)
+        return snapshots
+
+    def profile_start(self, mode, interval):
+        errors = []
+        for worker in self.workers:
+            error = self.call(worker, "profile_start", mode, interval)
+            if error:
+                errors.append(error)
+        return errors
+
+    def profile_stop(self, path):
+        """Each worker writes its own profile next to path."""
+        replies = []
+        for worker in self.workers:
+            replies.append(self.call(worker, "profile_stop", "%s.shard%d" % (path, worker.index)))
+        return replies
+
+    def sync(self, readerid):
+        return self.call(self.worker(readerid), "sync", readerid)
+
+    def reply_loop(self):
+        while True:
+            try:
+                msg = self.replies.get()
+                if msg[0] == "send":
+                    kind, payload, addr = msg
+                    self.sock.sendto(payload, addr)
+                elif msg[0] == "command":
+                    kind, token, result = msg
+                    with self.pending_lock:
+                        if self.pending.has_key(token):
+                            self.pending[token][1] = result
+                            self.pending[token][0].set()
+            except Exception:
+                logging.exception("Error in shard reply loop")
+
+    def forward_loop(self, source, deliver):
+        while True:
+            try:
+                deliver(source.get())
+            except Exception:
+                logging.exception("Error forwarding shard output")
@@ -0,0 +1,202 @@
+import errno
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+class Spool(object):
+    """Append-only on-disk queue for events that must survive a restart.
+
+    Records are JSON lines in segment files <directory>/<name>.<n>.log. The
+    consumer's acknowledged position is kept in <directory>/<name>.ack and
+    segments wholly before it are deleted. put() only appends to a buffer;
+    a flusher thread writes and fsyncs the buffer every sync_interval
+    seconds, so a burst of events never waits on the disk. Records become
+    readable once they are durable. Delivery is at least once: records read
+    but not acknowledged before a crash are read again after the restart.
+    """
+
+    segment_size = 16*1024*1024
+    sync_interval = 0.05
+
+    def __init__(self, directory, name, notify=None):
+        self.directory = directory
+        self.name = name
+        # called without the lock held whenever new records become readable
+        self.notify = notify
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.pending = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        segments = self._segments()
+        self.ack_position = self._load_ack(segments)
+        if segments:
+            self.write_segment = segments[-1]
+        else:
+            self.write_segment = self.ack_position[0]
+        self.write_offset = self._recover(self.write_segment)
+        self.fh = open(self._path(self.write_segment), "ab")
+        self.read_position = self.ack_position
+        self.read_fh = None
+        self.read_segment = None
+        self.pending = self._count(self.ack_position)
+        if self.pending:
+            logging.info("spool %s: %d unacknowledged records to replay" % (name, self.pending))
+        self.ack_dirty = False
+
+    def start(self):
+        """Start the flusher thread; nothing is written to disk until then."""
+        t = threading.Thread(target=self._flush_loop)
+        t.daemon = True
+        t.start()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, "%s.%012d.log" % (self.name, segment))
+
+    def _segments(self):
+        segments = []
+        for path in glob.glob(os.path.join(self.directory, "%s.*.log" % (self.name))):
+            try:
+                segments.append(int(os.path.basename(path)[len(self.name)+1:-4]))
+            except ValueError:
+                pass
+        return sorted(segments)
+
+    def _load_ack(self, segments):
+        try:
+            segment, offset = open(os.path.join(self.directory, "%s.ack" % (self.name))).read().split()
+            if segments and int(segment) < segments[0]:
+                return (segments[0], 0)
+            return (int(segment), int(offset))
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        if segments:
+            return (segments[0], 0)
+        return (0, 0)
+
+    def _recover(self, segment):
+        """Drop a partly written record left at the end of the last segment."""
+        path = self._path(segment)
+        if not os.path.exists(path):
+            return 0
+        fh = open(path, "r+b")
+        try:
+            data = fh.read()
+            end = data.rfind("\n")+1
+            if end != len(data):
+                logging.warning("spool %s: discarding %d bytes of incomplete record" % (self.name, len(data)-end))
+                fh.truncate(end)
+            return end
+        finally:
+            fh.close()
+
+    def _count(self, position):
+        count = 0
+        segment, offset = position
+        for s in self._segments():
+            if s < segment:
+                continue
+            fh = open(self._path(s), "rb")
+            if s == segment:
+                fh.seek(offset)
+            count += sum(1 for line in fh)
+            fh.close()
+        return count
+
+    def qsize(self):
+        return self.pending
+
+    def put(self, item):
+        line = json.dumps(item)+"\n"
+        with self.lock:
+            self.buffer.append(line)
+            self.pending += 1
+
+    def _flush_loop(self):
+        while True:
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("spool %s: flush failed" % (self.name))
+            time.sleep(self.sync_interval)
+
+    def flush(self):
+        with self.lock:
+            buffer = self.buffer
+            self.buffer = []
+            ack_position = self.ack_position
+            ack_dirty = self.ack_dirty
+            self.ack_dirty = False
+        if buffer:
+            data = "".join(buffer)
+            self.fh.write(data)
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+            with self.lock:
+                self.write_offset += len(data)
+                if self.write_offset >= self.segment_size:
+                    self.fh.close()
+                    self.write_segment += 1
+                    self.write_offset = 0
+                    self.fh = open(self._path(self.write_segment), "ab")
+            if self.notify:
+                self.notify()
+        if ack_dirty:
+            self._save_ack(ack_position)
+
+    def _save_ack(self, position):
+        path = os.path.join(self.directory, "%s.ack" % (self.name))
+        fh = open(path+".tmp", "w")
+        fh.write("%d %d\n" % position)
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+        os.rename(path+".tmp", path)
+        for segment in self._segments():
+            if segment < position[0]:
+                os.unlink(self._path(segment))
+
+    def readable(self):
+        with self.lock:
+            return self.read_position < (self.write_segment, self.write_offset)
+
+    def read(self, max_items):
+        """Return up to max_items of (position after record, item), without waiting."""
+        records = []
+        with self.lock:
+            end = (self.write_segment, self.write_offset)
+        while len(records) < max_items and self.read_position < end:
+            segment, offset = self.read_position
+            if self.read_segment != segment:
+                if self.read_fh:
+                    self.read_fh.close()
+                self.read_fh = open(self._path(segment), "rb")
+                self.read_segment = segment
+            self.read_fh.seek(offset)
+            line = self.read_fh.readline()
+            if not line:
+                # end of a finished segment
+                self.read_position = (segment+1, 0)
+                continue
+            self.read_position = (segment, offset+len(line))
+            item = json.loads(line)
+            if type(item) is list:
+                item = tuple(item)
+            records.append((self.read_position, item))
+        return records
+
+    def ack(self, position, count):
+        """Everything up to position (count records) has been delivered."""
+        with self.lock:
+            self.ack_position = position
+            self.ack_dirty = True
+            self.pending -= count
+
+    def rewind(self):
+        """Read again from the acknowledged position."""
+        with self.lock:
+            self.read_position = self.ack_position
@@ -0,0 +1,138 @@
+import bisect
+import threading
+import time
+
+# histogram bucket upper bounds in seconds: 10us doubling up to ~10s
+BUCKETS = [0.00001 * 2**i for i in range(21)]
+
+class Histogram(object):
+    """Fixed-bucket latency histogram that can be merged across processes."""
+
+    def __init__(self, counts=None, total=0.0, maximum=0.0):
+        self.counts = counts or [0] * (len(BUCKETS)+1)
+        self.total = total
+        self.maximum = maximum
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p'th percentile."""
+        n = self.count()
+        if n == 0:
+            return None
+        target = p/100.0*n
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target and c > 0:
+                if i < len(BUCKETS):
+                    return min(BUCKETS[i], self.maximum)
+                return self.maximum
+        return self.maximum
+
+    def merge(self, other):
+        self.counts = [a+b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+    def summary(self):
+        n = self.count()
+        if n == 0:
+            return {"count": 0}
+        return {
+            "count": n,
+            "mean": self.total/n,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.maximum,
+            }
+
+class Stats(object):
+    """Counters, latency histograms and gauges for the controller.
+
+    Histograms are named "<stage>/<packet type>". Gauges are callables
+    sampled when a snapshot is taken, e.g. queue depths.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, stage, packet_type, seconds):
+        name = "%s/%s" % (stage, packet_type)
+        with self.lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = Histogram()
+            h.observe(seconds)
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def snapshot(self):
+        """Plain data copy of the current values, suitable for pickling."""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict([(k, (list(h.counts), h.total, h.maximum)) for k, h in self.histograms.items()])
+        gauges = {}
+        for name, function in self.gauges.items():
+            try:
+                gauges[name] = function()
+            except Exception:
+                gauges[name] = None
+        return {"uptime": time.time()-self.started, "counters": counters, "histograms": histograms, "gauges": gauges}
+
+def merge_snapshots(snapshots):
+    merged = {"uptime": 0, "counters": {}, "histograms": {}, "gauges": {}}
+    for s in snapshots:
+        merged["uptime"] = max(merged["uptime"], s["uptime"])
+        for k, v in s["counters"].items():
+            merged["counters"][k] = merged["counters"].get(k, 0) + v
+        for k, v in s["histograms"].items():
+            h = Histogram(*v)
+            if merged["histograms"].has_key(k):
+                h.merge(Histogram(*merged["histograms"][k]))
+            merged["histograms"][k] = (h.counts, h.total, h.maximum)
+        for k, v in s["gauges"].items():
+            if v is not None:
+                merged["gauges"][k] = merged["gauges"].get(k, 0) + v
+    return merged
+
+def summarize(snapshot):
+    """Convert a snapshot into counters, gauges and histogram summaries."""
+    return {
+        "uptime": snapshot["uptime"],
+        "counters": snapshot["counters"],
+        "gauges": snapshot["gauges"],
+        "histograms": dict([(k, Histogram(*v).summary()) for k, v in snapshot["histograms"].items()]),
+        }
+
+def format_lines(snapshot):
+    summary = summarize(snapshot)
+    lines = ["uptime %.0f" % (summary["uptime"])]
+    for k in sorted(summary["counters"].keys()):
+        lines.append("counter %s %d" % (k, summary["counters"][k]))
+    for k in sorted(summary["gauges"].keys()):
+        lines.append("gauge %s %s" % (k, summary["gauges"][k]))
+    for k in sorted(summary["histograms"].keys()):
+        h = summary["histograms"][k]
+        if h["count"] == 0:
+            continue
+        lines.append("histogram %s count=%d mean=%.3fms p50=%.3fms p90=%.3fms p99=%.3fms max=%.3fms" % (
+            k, h["count"], h["mean"]*1e3, h["p50"]*1e3, h["p90"]*1e3, h["p99"]*1e3, h["max"]*1e3))
+    return lines
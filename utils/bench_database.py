@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#
+# Microbenchmark for CardDatabase.auth() and cards_for_reader().
+#
+# Generates synthetic cards.conf/readers.conf files of increasing size and
+# reports the mean lookup time, which should stay flat as the number of
+# members grows. "uncached" bypasses the auth cache to time the index
+# lookup itself. "parse" and "snapshot" are the time to load the database
+# from the .conf files and from a binary snapshot respectively.
+
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import database
+
+logging.getLogger().setLevel(logging.WARNING)
+
+GROUPS = ["members", "directors", "workshop", "laser", "storage"]
+
+def write_files(directory, people, readers=20):
+    rnd = random.Random(people)
+    uids = []
+    cards_filename = os.path.join(directory, "cards.conf")
+    readers_filename = os.path.join(directory, "readers.conf")
+    with open(cards_filename, "w") as f:
+        for n in range(people):
+            f.write("[Person %d]\n" % (n))
+            f.write("groups = %s\n" % (" ".join(rnd.sample(GROUPS, rnd.randint(1, 3)))))
+            for c in range(rnd.randint(1, 3)):
+                uid = "%014X" % (rnd.getrandbits(56))
+                uids.append(uid)
+                f.write("%s = Token %d\n" % (uid, c))
+            f.write("\n")
+    with open(readers_filename, "w") as f:
+        for n in range(readers):
+            f.write("[ESP_OR_%08X]\n" % (n))
+            f.write("groups = %s\n\n" % (rnd.choice(GROUPS)))
+    return cards_filename, readers_filename, uids
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [100, 1000, 5000, 20000]
+    iterations = 20000
+    print "%8s %8s %12s %12s %12s %14s %10s %10s" % ("people", "cards", "auth hit", "auth miss", "uncached", "cards_for_rdr", "parse", "snapshot")
+    for size in sizes:
+        directory = tempfile.mkdtemp()
+        try:
+            cards_filename, readers_filename, uids = write_files(directory, size)
+            snapshot_filename = os.path.join(directory, "database.snapshot")
+            t0 = time.time()
+            db = database.CardDatabase(cards_filename, readers_filename, snapshot_filename)
+            t_parse = time.time()-t0
+            t0 = time.time()
+            db = database.CardDatabase(cards_filename, readers_filename, snapshot_filename)
+            t_snapshot = time.time()-t0
+            reader = "ESP_OR_00000000"
+            hit = uids[len(uids) // 2]
+            t_hit = timeit.timeit(lambda: db.auth(reader, hit), number=iterations)
+            t_miss = timeit.timeit(lambda: db.auth(reader, "DEADBEEF"), number=iterations)
+            t_uncached = timeit.timeit(lambda: db._auth(reader, hit), number=iterations)
+            t_cards = timeit.timeit(lambda: db.cards_for_reader(reader), number=100)
+            print "%8d %8d %10.2fus %10.2fus %10.2fus %12.2fus %8.1fms %8.1fms" % (
+                size, len(uids),
+                t_hit / iterations * 1e6,
+                t_miss / iterations * 1e6,
+                t_uncached / iterations * 1e6,
+                t_cards / 100 * 1e6,
+                t_parse * 1e3,
+                t_snapshot * 1e3)
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
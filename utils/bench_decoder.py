@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+#
+# Regression corpus and throughput benchmark for decoder.decode_packet().
+#
+# Builds a deterministic corpus of reader packets (every packet type, every
+# variable code, truncated and corrupt streams) and checks that the current
+# decoder produces exactly what the original slicing decoder did, then
+# reports packets per second for each packet type.
+
+import logging
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import decoder
+
+logging.getLogger().setLevel(logging.CRITICAL)
+
+# the decoder as it was before it became table driven
+
+def legacy_decode_var(data):
+    var_type = ord(data[0])
+    name, fmt, process = decoder.data_variables[var_type]
+    required_length = struct.calcsize(fmt)
+    unpacked = struct.unpack(fmt, data[1:required_length+1])
+    remaining = data[required_length+1:]
+    if process is None:
+        # treat as number
+        return (name, unpacked[0], remaining)
+    elif type(process) in [int, float]:
+        # treat as a divider
+        return (name, unpacked[0]/process, remaining)
+    elif type(process) in [str, unicode]:
+        # treat as a format string
+        return (name, process % unpacked, remaining)
+    elif type(process) is dict:
+        # treat as lookup table
+        return (name, process[unpacked[0]], remaining)
+    else:
+        # treat as function
+        return (name, process(*unpacked), remaining)
+
+def legacy_decode_packet(data):
+    if data[0] == chr(0):
+        return {"type": "hello", "clientid": data[1:].rstrip(chr(0))}
+    elif data[0] == chr(1):
+        cmd, padding1, padding2, padding3, chipId, flashChipId, flashChipSize, flashChipSpeed, freeHeap, cardDatabaseSize, padding4, millis = struct.unpack(">BBBBIIIIIHHI", data[0:32])
+        output = {
+            "type": "systeminfo",
+            "chipId": "%08X" % (chipId),
+            "flashChipId": "%08X" % (flashChipId),
+            "flashChipSize": flashChipSize,
+            "flashChipSpeed": flashChipSpeed,
+            "freeHeap": freeHeap,
+            "cardDatabaseSize": cardDatabaseSize,
+            "millis": millis
+            }
+        return output
+    elif data[0] == chr(2):
+        cmd, inputBits, stateBits, authState, batteryVoltage, uidLen = struct.unpack(">BBBBHB", data[0:7])
+        output = {
+            "type": "status",
+            "batteryVoltage": batteryVoltage/100.0,
+            "authState": authState,
+            "uid": None,
+            "lowPowerMode": False,
+            "snibEnabled": False,
+            "unlockedByExit": False,
+            "unlockedBySnib": False,
+            "unlockedByCard": False,
+            "exitRequest": False,
+            "snibPressed": False,
+            "snibLongPressed": False,
+            "doorOpen": False
+            }
+        if stateBits & 16:
+            output["lowPowerMode"] = True
+        if stateBits & 8:
+            output["snibEnabled"] = True
+        if stateBits & 4:
+            output["unlockedByExit"] = True
+        if stateBits & 2:
+            output["unlockedBySnib"] = True
+        if stateBits & 1:
+            output["unlockedByCard"] = True
+        if inputBits & 8:
+            output["snibLongPressed"] = True
+        if inputBits & 4:
+            output["snibPressed"] = True
+        if inputBits & 2:
+            output["exitRequest"] = True
+        if inputBits & 1:
+            output["doorOpen"] = True
+        if uidLen>0 and uidLen<=7:
+            output['uid'] = legacy_hexify(data[7:7+uidLen])
+        return output
+    elif data[0] == chr(3):
+        uidLen = ord(data[1])
+        if uidLen>0 and uidLen<=7:
+            return {
+                "type": "authrequest",
+                "uid": legacy_hexify(data[2:2+uidLen])
+            }
+    elif data[0] == chr(4):
+        data2 = data[1:]
+        output = {"type": "databasedump", "data": {}}
+        while len(data2) >= 9:
+            slot, uidlen, uid = struct.unpack(">HB7s", data2[0:10])
+            #print slot, uidlen, legacy_hexify(uid, sep="-")
+            slot = int(slot)
+            uid = uid[0:uidlen]
+            output["data"][slot] = legacy_hexify(uid)
+            data2 = data2[10:]
+        return output
+    elif data[0] == chr(5):
+        # stream of variables
+        data2 = data[1:]
+        output = {"type": "variables"}
+        while len(data2) > 0:
+            try:
+                k, v, data2 = legacy_decode_var(data2)
+                output[k] = v
+            except Exception, e:
+                logging.exception("Exception while decoding %s (ignoring remaining data)" % (legacy_hexify(data2, sep="-")))
+                return output
+        return output
+
+def legacy_hexify(data, sep=""):
+    output = []
+    for d in data:
+        output.append("%02X" % (struct.unpack("B", d)))
+    return sep.join(output)
+
+def encode_variable(rnd, code):
+    name, fmt, process = decoder.data_variables[code]
+    if type(process) is dict:
+        return chr(code) + struct.pack(fmt, rnd.choice(process.keys()))
+    values = []
+    for c in fmt[1:]:
+        if c.isdigit():
+            continue
+        values.append(rnd.randint(0, {"B": 0xFF, "H": 0xFFFF, "I": 0xFFFFFFFF}[c]))
+    if fmt == ">6B":
+        values = [rnd.randint(0, 0xFF) for i in range(6)]
+    elif fmt == ">B7B":
+        values = [rnd.randint(0, 7)] + [rnd.randint(0, 0xFF) for i in range(7)]
+    return chr(code) + struct.pack(fmt, *values)
+
+def random_uid(rnd):
+    uidlen = rnd.choice([4, 7])
+    return uidlen, "".join([chr(rnd.randint(0, 255)) for i in range(uidlen)])
+
+def corpus(seed=1):
+    rnd = random.Random(seed)
+    packets = {"hello": [], "systeminfo": [], "status": [], "authrequest": [], "databasedump": [], "variables": [], "invalid": []}
+    for i in range(200):
+        packets["hello"].append("\x00ESP_OR_%08X" % (rnd.getrandbits(32)) + "\x00" * rnd.randint(0, 3))
+        packets["systeminfo"].append(struct.pack(">BBBBIIIIIHHI", 1, 0, 0, 0, *[rnd.getrandbits(32) for j in range(5)] + [rnd.getrandbits(16), 0, rnd.getrandbits(32)]))
+        uidlen, uid = random_uid(rnd)
+        packets["status"].append(struct.pack(">BBBBHB", 2, rnd.getrandbits(4), rnd.getrandbits(5), rnd.randint(0, 6), rnd.getrandbits(16), rnd.choice([0, uidlen, 9])) + uid)
+        packets["authrequest"].append("\x03" + chr(rnd.choice([uidlen, uidlen, 0, 8])) + uid)
+        entries = []
+        for slot in range(rnd.randint(0, 100)):
+            uidlen, uid = random_uid(rnd)
+            if rnd.random() < 0.3:
+                uidlen, uid = 0, ""
+            entries.append(struct.pack(">HB7s", slot, uidlen, uid))
+        packets["databasedump"].append("\x04" + "".join(entries))
+        codes = decoder.data_variables.keys()
+        stream = "".join([encode_variable(rnd, rnd.choice(codes)) for j in range(rnd.randint(1, 40))])
+        if rnd.random() < 0.1:
+            # truncated stream
+            stream = stream[:rnd.randint(1, len(stream))]
+        elif rnd.random() < 0.1:
+            # unknown variable code part way through
+            stream = stream + "\xEE\x00" + stream
+        packets["variables"].append("\x05" + stream)
+    packets["variables"].append("\x05" + "".join([encode_variable(rnd, code) for code in decoder.data_variables.keys()]))
+    packets["invalid"].extend(["\x06", "\x7F\x00\x01", "\x04" + "\x00" * 9])
+    return packets
+
+def outcome(function, packet):
+    try:
+        return function(packet)
+    except Exception, e:
+        return type(e)
+
+def main():
+    packets = corpus()
+    failures = 0
+    for kind in sorted(packets.keys()):
+        for packet in packets[kind]:
+            expected = outcome(legacy_decode_packet, packet)
+            actual = outcome(decoder.decode_packet, packet)
+            if expected != actual:
+                failures += 1
+                print "MISMATCH %s %s: %r != %r" % (kind, legacy_hexify(packet, sep="-"), actual, expected)
+    print "corpus: %d packets, %d mismatches" % (sum([len(p) for p in packets.values()]), failures)
+    print "%-14s %14s %14s %8s" % ("type", "legacy pkt/s", "decoder pkt/s", "speedup")
+    for kind in ["status", "authrequest", "databasedump", "variables"]:
+        rates = []
+        for function in [legacy_decode_packet, decoder.decode_packet]:
+            start = time.time()
+            n = 0
+            while time.time()-start < 1:
+                for packet in packets[kind]:
+                    outcome(function, packet)
+                n += len(packets[kind])
+            rates.append(n / (time.time()-start))
+        print "%-14s %14.0f %14.0f %7.1fx" % (kind, rates[0], rates[1], rates[1] / rates[0])
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
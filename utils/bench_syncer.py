@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# Benchmark for manager.Syncer.changes() against the original deepcopy /
+# list.remove() implementation, at realistic reader database sizes.
+#
+# Each scenario fills a reader image to roughly 75% and then changes a few
+# percent of the membership, which is what a typical reload looks like.
+
+import copy
+import logging
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import manager
+
+logging.getLogger().setLevel(logging.WARNING)
+
+def legacy_changes(slots, reader_data, uids):
+    target_data = copy.deepcopy(reader_data)
+    uids = copy.deepcopy(uids)
+    for slot in range(0, slots):
+        if target_data[slot] == "FFFFFFFFFFFFFF":
+            target_data[slot] = ""
+        if target_data[slot].lstrip("0") == "":
+            target_data[slot] = ""
+        if target_data[slot] in uids:
+            uids.remove(target_data[slot])
+        else:
+            target_data[slot] = ""
+    for slot in range(0, slots):
+        if len(uids) == 0:
+            break
+        if target_data[slot] == "":
+            target_data[slot] = uids.pop()
+    output = []
+    changelist = {}
+    for slot in range(0, slots):
+        if target_data[slot] != reader_data[slot]:
+            changelist[slot] = target_data[slot]
+            if len(changelist.keys()) >= 128:
+                output.append({"type": "databaseset", "slots": changelist})
+                changelist = {}
+    if len(changelist.keys()) > 0:
+        output.append({"type": "databaseset", "slots": changelist})
+    return output
+
+def scenario(slots, churn=0.02):
+    rnd = random.Random(slots)
+    cards = ["%014X" % (rnd.getrandbits(56)) for i in range(int(slots * 0.75))]
+    reader_data = {}
+    for slot in range(slots):
+        if slot < len(cards):
+            reader_data[slot] = cards[slot]
+        else:
+            reader_data[slot] = ""
+    # earlier removals leave blank holes between the cards
+    for slot in rnd.sample(range(len(cards)), len(cards) // 20):
+        reader_data[slot] = ""
+    present = [uid for uid in reader_data.values() if uid != ""]
+    changed = int(len(present) * churn)
+    removed = set(rnd.sample(present, changed))
+    uids = [uid for uid in present if uid not in removed] + ["%014X" % (rnd.getrandbits(56)) for i in range(changed)]
+    return reader_data, sorted(uids)
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [2000, 4000, 8000]
+    print "%6s %12s %12s %8s %14s %8s" % ("slots", "legacy", "syncer", "speedup", "legacy writes", "writes")
+    for slots in sizes:
+        reader_data, uids = scenario(slots)
+        syncer = manager.Syncer()
+        syncer.setSlots(slots)
+        for slot, uid in reader_data.items():
+            syncer.receivedSlot(slot, uid)
+        syncer.setUids(uids)
+        expected = legacy_changes(slots, reader_data, uids)
+        result = syncer.changes()
+        writes = sum([len(p["slots"]) for p in result])
+        legacy_writes = sum([len(p["slots"]) for p in expected])
+        assert writes <= legacy_writes
+        number = 5
+        t_legacy = timeit.timeit(lambda: legacy_changes(slots, reader_data, uids), number=number) / number
+        t_new = timeit.timeit(syncer.changes, number=number) / number
+        print "%6d %10.2fms %10.2fms %7.1fx %14d %8d" % (slots, t_legacy * 1e3, t_new * 1e3, t_legacy / t_new, legacy_writes, writes)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#
+# Copy cards.conf and readers.conf into the SQLite card database used with
+# database_backend = sqlite.
+#
+# Only rows that differ are written, in a single transaction, so running
+# this after every edit of the .conf files records just the real changes in
+# the change feed and the controller applies them incrementally. The
+# controller prunes the feed itself, keeping the most recent
+# full_reload_threshold changes, so no other cleanup is needed.
+#
+# usage: conf2sqlite.py cards.conf readers.conf cards.sqlite
+
+import logging
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import database
+
+def sync_rows(db, table, columns, key_columns, rows):
+    """Make table hold exactly rows, touching only those that differ."""
+    current = {}
+    for row in db.execute("SELECT %s FROM %s" % (", ".join(columns), table)):
+        current[tuple(row[:key_columns])] = tuple(row)
+    wanted = dict([(tuple(row[:key_columns]), tuple(row)) for row in rows])
+    changed = 0
+    for key, row in current.items():
+        if not wanted.has_key(key):
+            db.execute("DELETE FROM %s WHERE %s" % (table, " AND ".join(["%s = ?" % c for c in columns[:key_columns]])), key)
+            changed += 1
+    for key, row in wanted.items():
+        if current.get(key) != row:
+            db.execute("INSERT OR REPLACE INTO %s (%s) VALUES (%s)" % (table, ", ".join(columns), ", ".join(["?"]*len(columns))), row)
+            changed += 1
+    return changed
+
+def main():
+    if len(sys.argv) != 4:
+        print "usage: %s cards.conf readers.conf cards.sqlite" % (sys.argv[0])
+        sys.exit(1)
+    cards_filename, readers_filename, sqlite_filename = sys.argv[1:]
+    source = database.CardDatabase(cards_filename, readers_filename)
+    people = source._load_cards()
+    readers = source._load_readers()
+
+    db = sqlite3.connect(sqlite_filename)
+    database.SqliteCardDatabase.create(db)
+    changed = 0
+    changed += sync_rows(db, "people", ["name", "private"], 1,
+        [(name, int(p["private"])) for name, p in people.items()])
+    changed += sync_rows(db, "person_groups", ["person", "grp"], 2,
+        [(name, grp) for name, p in people.items() for grp in p["groups"]])
+    changed += sync_rows(db, "cards", ["uid", "person", "token_name"], 2,
+        [(uid, name, token_name) for name, p in people.items() for uid, token_name in p["cards"].items()])
+    changed += sync_rows(db, "readers", ["id", "name", "mqtt_id"], 1,
+        [(readerid, r["name"], r["id"]) for readerid, r in readers.items()])
+    changed += sync_rows(db, "reader_groups", ["reader", "grp"], 2,
+        [(readerid, grp) for readerid, r in readers.items() for grp in r["groups"]])
+    changed += sync_rows(db, "reader_settings", ["reader", "key", "value"], 2,
+        [(readerid, k, v) for readerid, r in readers.items() for k, v in r["settings"].items()])
+    db.commit()
+    db.close()
+    print "%d rows changed" % (changed)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()